@@ -0,0 +1,139 @@
+"""Long-lived agent that runs olut commands sent over a Unix socket.
+
+The agent keeps an Olut instance, and with it the parsed package index,
+in memory so small commands like list, activate and render don't pay for
+interpreter startup and re-reading state on every call. The protocol is
+one JSON object per line: {"method", "args", "kwargs"} in and
+{"result", "output", "status", "error"} back.
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+from StringIO import StringIO
+
+from olut.command import render_all, render_template
+
+log = logging.getLogger("olut")
+
+AGENT_SOCKET_FILENAME = ".agent.sock"
+# Commands the agent serves. Anything slower than process startup (build,
+# install, verify, ...) runs in process as before.
+AGENT_COMMANDS = ("list", "info", "activate", "deactivate", "render", "render_all")
+
+class AgentError(Exception):
+    """The agent accepted a command but failed to return a response"""
+
+
+def get_socket_path(install_path):
+    return os.getenv("OLUT_AGENT_SOCKET") or os.path.join(install_path, AGENT_SOCKET_FILENAME)
+
+
+class AgentHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = dict(result=None, output="", status=1, error="Invalid request")
+            else:
+                response = self.server.dispatch(request)
+            self.wfile.write(json.dumps(response, default=str) + "\n")
+            self.wfile.flush()
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, olut, path):
+        self.olut = olut
+        # Commands print to stdout so only one runs at a time
+        self.command_lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                call(path, "ping")
+            except socket.error:
+                # Left behind by an agent that didn't shut down cleanly
+                os.unlink(path)
+            else:
+                raise Exception("An agent is already listening on %s" % path)
+        SocketServer.UnixStreamServer.__init__(self, path, AgentHandler)
+        os.chmod(path, 0600)
+
+    def dispatch(self, request):
+        method = request.get("method")
+        args = request.get("args") or []
+        kwargs = dict((str(k), v) for k, v in (request.get("kwargs") or {}).iteritems())
+        if kwargs.get("environ"):
+            # Scripts get this as their environment so it has to be str
+            kwargs["environ"] = dict(
+                (k.encode("utf-8"), v.encode("utf-8")) for k, v in kwargs["environ"].iteritems())
+        if method == "ping":
+            return dict(result="pong", output="", status=0, error=None)
+        if method not in AGENT_COMMANDS:
+            return dict(result=None, output="", status=1, error="Unknown command %s" % method)
+        if method == "render":
+            func = render_template
+        elif method == "render_all":
+            func = render_all
+        else:
+            func = getattr(self.olut, method)
+
+        output = StringIO()
+        handler = logging.StreamHandler(output)
+        result, status, error = None, 0, None
+        with self.command_lock:
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = output
+            log.addHandler(handler)
+            try:
+                result = func(*args, **kwargs)
+            except SystemExit, e:
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception, e:
+                log.debug("%s failed", method, exc_info=True)
+                status, error = 1, "%s: %s" % (e.__class__.__name__, e)
+            finally:
+                log.removeHandler(handler)
+                sys.stdout, sys.stderr = stdout, stderr
+        return dict(result=result, output=output.getvalue(), status=status, error=error)
+
+
+def serve(olut, socket_path=None):
+    socket_path = socket_path or get_socket_path(olut.install_path)
+    server = AgentServer(olut, socket_path)
+    log.info("Agent listening on %s", socket_path)
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def call(socket_path, method, args=(), kwargs=None):
+    """Run a command in the agent and return its response. Raises
+    socket.error if no agent is listening and AgentError if the
+    connection fails after that, when the command may already have run."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        try:
+            sock.sendall(json.dumps(dict(method=method, args=list(args), kwargs=kwargs or {})) + "\n")
+            line = sock.makefile("rb").readline()
+        except socket.error, e:
+            raise AgentError("Lost the connection to the agent running %s: %s" % (method, e))
+    finally:
+        sock.close()
+    if not line:
+        raise AgentError("Agent closed the connection while running %s" % method)
+    return json.loads(line)
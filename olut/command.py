@@ -1,33 +1,101 @@
 #!/usr/bin/env python
 
+import collections
+import ctypes
 import datetime
+import errno
+import fcntl
+import fnmatch
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
+import signal
+import socket
+import stat
+import string
 import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
 import time
+import urllib
+import urllib2
 import yaml
-from contextlib import closing
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from StringIO import StringIO
 
+from olut.compression import COMPRESSION_TYPES, DEFAULT_COMPRESSION, check_compression, get_extension, open_tar_reader, open_tar_stream, open_tar_writer
+
 class Olut(object):
     DEFAULT_IGNORE_FILENAME_RE = re.compile(".*(\.py[co]|\.swp|~)$")
     DEFAULT_INSTALL_PATH = "/var/lib/olut"
+    INDEX_FILENAME = ".index.json"
+    OBJECTS_DIRNAME = ".objects"
+    BUILD_CACHE_DIRNAME = ".olut-cache"
+    LOCKS_DIRNAME = ".locks"
+    SCRIPT_TAIL_LINES = 100
+    TRASH_DIRNAME = ".trash"
+    LAYERS_DIRNAME = ".layers"
+    REPOSITORY_INDEX_FILENAME = "index.json"
+    # Staging dirs older than this are left over from a crash and removed
+    # by gc
+    STAGING_MAX_AGE = 24*60*60
+    DEDUP_MEMORY_LIMIT = 1024*1024
     
-    def __init__(self, install_path=None, ignore_filename_re=None, gitdepth=1, ssh_agent_forward=False):
+    def __init__(self, install_path=None, ignore_filename_re=None, gitdepth=1, ssh_agent_forward=False, dedup=False,
+                 script_timeout=None, script_log_limit=None, timings=None,
+                 keep_versions=None, keep_days=None, background_gc=False, cache_index=False,
+                 repository=None, durable=False):
         self.log = logging.getLogger("olut")
         self.gitdepth = gitdepth
         self.install_path = install_path or os.getenv("OLUT_INSTALL_PATH") or self.DEFAULT_INSTALL_PATH
         self.ignore_filename_re = ignore_filename_re or os.getenv("OLUT_IGNORE_FILENAME_RE") or self.DEFAULT_IGNORE_FILENAME_RE
         self.ssh_agent_forward = ssh_agent_forward
+        self.dedup = dedup or bool(os.getenv("OLUT_DEDUP"))
+        self.script_timeout = script_timeout
+        self.script_log_limit = script_log_limit
+        if keep_versions is not None and keep_versions < 1:
+            raise ValueError("keep_versions must be at least 1, not %r" % keep_versions)
+        self.keep_versions = keep_versions
+        self.keep_days = keep_days
+        self.background_gc = background_gc
+        self.cache_index = cache_index
+        # Directory or http(s) URL of a package repository to resolve
+        # install name[@spec] through
+        self.repository = repository or os.getenv("OLUT_REPOSITORY")
+        # Flush installed files to disk before they're renamed into place
+        self.durable = durable or bool(os.getenv("OLUT_DURABLE"))
+        self._index_cache = None
+        self._locks = threading.local()
+        # timings is a file object or a path ("-" for stderr) to write
+        # JSON timing events to
+        self.timings = timings or os.getenv("OLUT_TIMINGS")
+        if self.timings == "-":
+            self.timings = sys.stderr
+        elif isinstance(self.timings, basestring):
+            self.timings = open(self.timings, "a")
+        self._timings_lock = threading.Lock()
         if isinstance(self.ignore_filename_re, basestring):
             self.ignore_filename_re = re.compile(self.ignore_filename_re)
 
-    def build(self, sourcepath, outpath=".", metapath="olut", metaoverride=None, ignoreunknown=False):
+    def build(self, sourcepath, outpath=".", metapath="olut", metaoverride=None, ignoreunknown=False,
+              compression=DEFAULT_COMPRESSION, level=None, base=None, cache=False,
+              gitfiles=False, reproducible=False):
+        with self.timed("build", source=sourcepath) as t:
+            t["package"] = self._build(sourcepath, outpath, metapath, metaoverride, ignoreunknown,
+                compression, level, base, cache, gitfiles, reproducible)
+        return t["package"]
+
+    def _build(self, sourcepath, outpath, metapath, metaoverride, ignoreunknown,
+               compression, level, base, cache, gitfiles, reproducible):
+        check_compression(compression)
         if not os.path.exists(outpath):
             os.makedirs(outpath)
         
@@ -35,8 +103,22 @@ class Olut(object):
         if not os.path.exists(sourcepath):
             raise IOError("Source path does not exist")
         
+        if reproducible:
+            # Every timestamp in the package, and the version of untagged
+            # git builds, comes from SOURCE_DATE_EPOCH (or 0) and owners
+            # and permissions are normalized so the same input always
+            # gives the same bytes
+            epoch = int(os.getenv("SOURCE_DATE_EPOCH") or 0)
+        else:
+            epoch = None
+
         # read & generate meta
-        meta = self.get_git_meta(sourcepath, ignoreunknown)
+        meta = self.get_git_meta(sourcepath, ignoreunknown, ignored=not gitfiles, epoch=epoch)
+        if epoch is None and "version" in meta and "tag" not in meta["scm"]:
+            # Untagged git builds are versioned by the time of the build
+            generated_version = meta["version"]
+        else:
+            generated_version = None
         if not metapath.startswith('/'):
             metapath = os.path.join(sourcepath, metapath)
         metafile_path = os.path.join(metapath, "metadata.yaml")
@@ -47,100 +129,951 @@ class Olut(object):
                     meta.update(projmeta)
         if metaoverride:
             meta.update(metaoverride)
-        meta["build_date"] = datetime.datetime.now()
+        if reproducible:
+            meta["build_date"] = datetime.datetime.utcfromtimestamp(epoch)
+        else:
+            meta["build_date"] = datetime.datetime.now()
         
-        # Build package tar.gz
-        exclude_files = set(meta.pop('exclude_files', []))
-        include_files = set(meta.pop('include_files', []))
-        outname = "%s-%s.tgz" % (meta["name"], meta["version"])
+        # Build package tarball
+        exclude_files = PathMatcher(meta.pop('exclude_files', []))
+        include_files = PathMatcher(meta.pop('include_files', []))
+        with self.timed("build.collect", git=gitfiles) as t:
+            if gitfiles:
+                entries = self.collect_git_files(sourcepath, metapath, exclude_files, include_files)
+            else:
+                entries = self.collect_files(sourcepath, metapath, exclude_files, include_files)
+            t["files"] = len(entries)
+        if reproducible:
+            entries.sort(key=lambda x: x[1])
+        if cache:
+            cache_path = os.path.join(outpath, self.BUILD_CACHE_DIRNAME, "%s.json" % meta["name"])
+            build_cache = self.load_build_cache(cache_path)
+        else:
+            build_cache = None
+        with self.timed("build.manifest", files=len(entries)):
+            manifest = self.get_manifest(entries, cache=build_cache)
+        if reproducible:
+            manifest = [
+                (pkgpath, size, stat.S_IFMT(mode) | normalize_perm(mode), digest, epoch)
+                for pkgpath, size, mode, digest, mtime in manifest]
+            meta["content_hash"] = hashlib.sha256(format_manifest(manifest)).hexdigest()
+        layers = []
+        if meta.get("layers"):
+            entries, layers = self.split_layers(meta["layers"], entries, manifest)
+            for layer, layer_entries in layers:
+                layer["file"] = "%s-%s-%s.layer.%s" % (
+                    meta["name"], layer["name"], layer["hash"][:16], get_extension(compression))
+        deleted = []
+        if base:
+            # Delta package: only ship files that differ from the base and
+            # always the .olut/ scripts
+            base_meta, base_manifest = self.load_base_manifest(base)
+            meta["delta"] = dict(base_version=base_meta["version"])
+            unchanged = set(
+                row[0] for row in manifest
+                if not row[0].startswith(".olut/")
+                    and base_manifest.get(row[0]) == (row[2], row[3]))
+            entries = [x for x in entries if x[1] not in unchanged]
+            paths = set(row[0] for row in manifest)
+            deleted = sorted(x for x in base_manifest if x not in paths)
+            self.log.info("Delta against version %s: %d changed, %d unchanged, %d deleted files",
+                base_meta["version"], len(entries), len(unchanged), len(deleted))
+            outname = "%s-%s.delta.%s" % (meta["name"], meta["version"], get_extension(compression))
+        else:
+            outname = "%s-%s.%s" % (meta["name"], meta["version"], get_extension(compression))
         outpath = os.path.join(outpath, outname)
-        with closing(tarfile.open(outpath, "w:gz")) as fp:
-            for root, dirs, files in os.walk(sourcepath):
-                pkgroot = root[len(sourcepath)+1:]
-
-                toremove = []
-                for d in dirs:
-                    realpath = os.path.join(root, d)
-                    if os.path.islink(realpath):
-                        fp.add(realpath, os.path.join(pkgroot, d))
-                        toremove.append(d)
-                for x in toremove:
-                    dirs.remove(x)
-
-                # Skip ignored directories
-                if ".git" in dirs:
-                    dirs.remove(".git")
-                for d in list(dirs):
-                    if d not in include_files and (d in exclude_files or (d+"/") in exclude_files):
-                        dirs.remove(d)
-
-                #if pkgroot in exclude_files or (pkgroot+"/") in exclude_files:
-                #    continue
-
-                for f in files:
-                    realpath = os.path.join(root, f)
-                    pkgpath = os.path.join(pkgroot, f)
-                    if self.ignore_filename_re.match(pkgpath):
-                        continue
-                    if pkgpath not in include_files and pkgpath in exclude_files:
-                        continue
-                    
+        if cache:
+            input_meta = dict(meta)
+            del input_meta["build_date"]
+            cached_outpath = outpath
+            if generated_version is not None and meta["version"] == generated_version:
+                # A version made up from the build time changes every build
+                # so it's left out and the last build's package is reused
+                del input_meta["version"]
+                if build_cache["outpath"] and os.path.dirname(build_cache["outpath"]) == os.path.dirname(outpath):
+                    cached_outpath = build_cache["outpath"]
+            input_hash = hashlib.sha256("\0".join((
+                yaml.dump(input_meta, default_flow_style=False),
+                format_manifest(manifest),
+                repr((compression, level, reproducible)),
+            ))).hexdigest()
+            if build_cache["input_hash"] == input_hash and build_cache["outpath"] == cached_outpath \
+                    and os.path.exists(cached_outpath) \
+                    and all(os.path.exists(os.path.join(os.path.dirname(outpath), layer["file"]))
+                            for layer, layer_entries in layers):
+                self.log.info("Nothing changed since the last build of %s, skipping", cached_outpath)
+                return cached_outpath
+        for layer, layer_entries in layers:
+            self.write_layer(layer, layer_entries, os.path.dirname(outpath), compression, level, epoch)
+        with self.timed("build.write", compression=compression, files=len(entries)) as t:
+            with open_tar_writer(outpath, compression, level, reproducible=reproducible) as fp:
+                # Metadata and the file manifest go first so readers can stop
+                # without decompressing the rest of the package
+                eti = fp.gettarinfo(sourcepath) # Use an existing file to get uid, gid, etc..
+                normalize = None
+                if reproducible:
+                    normalize = reproducible_filter(epoch)
+                    eti = normalize(eti)
+                meta_yaml = yaml.dump(meta, default_flow_style=False)
+                self._add_string(fp, eti, ".olut/metadata.yaml", meta_yaml, epoch)
+                self._add_string(fp, eti, ".olut/manifest", format_manifest(manifest), epoch)
+                if base:
+                    self._add_string(fp, eti, ".olut/deleted", "".join(x+"\n" for x in deleted), epoch)
+
+                for realpath, pkgpath in entries:
                     self.log.debug(pkgpath)
-                    fp.add(realpath, pkgpath)
-            
-            # Include files from the metadata/scripts path
-            # except metadata.yaml which we deal with separately
-            for root, dirs, files in os.walk(metapath):
-                pkgroot = root[len(metapath)+1:]
-                for f in files:
-                    if self.ignore_filename_re.match(f):
-                        continue
-                    if f == "metadata.yaml":
-                        continue
-                    realpath = os.path.join(root, f)
-                    pkgpath = os.path.join(".olut", pkgroot, f)
-                    fp.add(realpath, pkgpath)
-            
-            # Write out modified metadata
-            meta_yaml = yaml.dump(meta, default_flow_style=False)
-            eti = fp.gettarinfo(sourcepath) # Use an existing file to get uid, gid, etc..
-            ti = tarfile.TarInfo(".olut/metadata.yaml")
-            ti.size = len(meta_yaml)
-            ti.mtime = time.time()
-            for k in ("uid", "gid", "uname", "gname"):
-                setattr(ti, k, getattr(eti, k))
-            fp.addfile(ti, StringIO(meta_yaml))
+                    fp.add(realpath, pkgpath, recursive=False, filter=normalize)
+            sizes = dict((row[0], row[1]) for row in manifest)
+            t["bytes_in"] = sum(sizes.get(pkgpath, 0) for realpath, pkgpath in entries)
+            t["bytes_out"] = os.path.getsize(outpath)
+        if cache:
+            build_cache.update(input_hash=input_hash, outpath=outpath)
+            self.save_build_cache(cache_path, build_cache)
+        repo_path = os.path.dirname(outpath)
+        if os.path.exists(os.path.join(repo_path, self.REPOSITORY_INDEX_FILENAME)):
+            if base:
+                self.log.info("Not adding delta package %s to the repository index", outpath)
+            else:
+                self.index_package(repo_path, outpath, meta)
         return outpath
 
+    def split_layers(self, layers, entries, manifest):
+        """Move the files matching each layer's paths out of entries.
+        Returns the remaining entries and a list of (layer, entries). The
+        layer dicts get a hash of their files' paths, modes and contents
+        (but not mtimes) so unchanged layers hash the same every build."""
+        rows = dict((row[0], row) for row in manifest)
+        result = []
+        for layer in layers:
+            matcher = PathMatcher(layer.get("paths", []))
+            layer_entries = [x for x in entries if matcher.match_tree(x[1], names=False)]
+            entries = [x for x in entries if not matcher.match_tree(x[1], names=False)]
+            layer["hash"] = hashlib.sha256(format_manifest(
+                sorted(rows[pkgpath][:4] + (0,) for realpath, pkgpath in layer_entries))).hexdigest()
+            layer["files"] = len(layer_entries)
+            result.append((layer, layer_entries))
+        return entries, result
+
+    def write_layer(self, layer, entries, outdir, compression, level, epoch=None):
+        """Write a layer's files to its own archive next to the package
+        unless an archive with the same hash is already there. With epoch
+        set the archive is reproducible."""
+        layer_path = os.path.join(outdir, layer["file"])
+        if os.path.exists(layer_path):
+            self.log.info("Layer %s is unchanged, reusing %s", layer["name"], layer_path)
+            return
+        with self.timed("build.layer", layer=layer["name"], files=len(entries)) as t:
+            tmp_path = layer_path + ".tmp"
+            normalize = reproducible_filter(epoch) if epoch is not None else None
+            with open_tar_writer(tmp_path, compression, level, reproducible=epoch is not None) as fp:
+                for realpath, pkgpath in entries:
+                    self.log.debug(pkgpath)
+                    fp.add(realpath, pkgpath, recursive=False, filter=normalize)
+            os.rename(tmp_path, layer_path)
+            t["bytes_out"] = os.path.getsize(layer_path)
+
+    def load_build_cache(self, path):
+        """Load a build cache which maps pkgpath to [size, mtime, inode,
+        sha256] and records the input hash and path of the last build"""
+        try:
+            with open(path, "rb") as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return dict(files={}, input_hash=None, outpath=None)
+
+    def save_build_cache(self, path, build_cache):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fp:
+            json.dump(build_cache, fp, separators=(",", ":"))
+        os.rename(tmp_path, path)
+
+    def collect_files(self, sourcepath, metapath, exclude_files, include_files):
+        """Return a list of (realpath, pkgpath) tuples to include in a package"""
+        entries = []
+        for root, dirs, files in os.walk(sourcepath):
+            pkgroot = root[len(sourcepath)+1:]
+
+            toremove = []
+            for d in dirs:
+                realpath = os.path.join(root, d)
+                if os.path.islink(realpath):
+                    entries.append((realpath, os.path.join(pkgroot, d)))
+                    toremove.append(d)
+            for x in toremove:
+                dirs.remove(x)
+
+            # Skip ignored directories
+            for d in (".git", self.BUILD_CACHE_DIRNAME):
+                if d in dirs:
+                    dirs.remove(d)
+            for d in list(dirs):
+                dirpath = os.path.join(pkgroot, d)
+                if (not include_files.match_dir(dirpath)
+                        and exclude_files.match_dir(dirpath)):
+                    dirs.remove(d)
+
+            for f in files:
+                realpath = os.path.join(root, f)
+                pkgpath = os.path.join(pkgroot, f)
+                if self.ignore_filename_re.match(pkgpath):
+                    continue
+                if not include_files.match(pkgpath) and exclude_files.match(pkgpath):
+                    continue
+                entries.append((realpath, pkgpath))
+
+        return entries + self.collect_meta_files(metapath)
+
+    def collect_git_files(self, sourcepath, metapath, exclude_files, include_files):
+        """Like collect_files but take the file list from git's index
+        instead of walking the source tree so ignored directories are
+        never visited. Only tracked files and include_files are added."""
+        proc = subprocess.Popen(["git", "ls-files", "-z"], cwd=sourcepath, stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise Exception("git ls-files returned a non-zero return code %d" % proc.returncode)
+        entries = []
+        seen = set()
+        for pkgpath in out.split("\0"):
+            realpath = os.path.join(sourcepath, pkgpath)
+            # Skip deleted files and submodules
+            if not pkgpath or not (os.path.islink(realpath) or os.path.isfile(realpath)):
+                continue
+            if self.ignore_filename_re.match(pkgpath):
+                continue
+            if not include_files.match_tree(pkgpath) and exclude_files.match_tree(pkgpath):
+                continue
+            entries.append((realpath, pkgpath))
+            seen.add(pkgpath)
+
+        # Untracked files have to be asked for explicitly. Only walk the
+        # part of the tree before the first wildcard of each pattern.
+        for pattern in include_files.patterns:
+            pattern = pattern.rstrip('/')
+            prefix = re.split(r"[*?[]", pattern, 1)[0]
+            if prefix != pattern:
+                prefix = prefix.rsplit('/', 1)[0] if "/" in prefix else ""
+            rootpath = os.path.join(sourcepath, prefix) if prefix else sourcepath
+            if os.path.islink(rootpath) or os.path.isfile(rootpath):
+                candidates = [(rootpath, prefix)]
+            else:
+                candidates = []
+                for root, dirs, files in os.walk(rootpath):
+                    if ".git" in dirs:
+                        dirs.remove(".git")
+                    pkgroot = root[len(sourcepath)+1:]
+                    for f in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                        candidates.append((os.path.join(root, f), os.path.join(pkgroot, f)))
+            for realpath, pkgpath in candidates:
+                if pkgpath in seen or not include_files.match_tree(pkgpath):
+                    continue
+                if self.ignore_filename_re.match(pkgpath):
+                    continue
+                entries.append((realpath, pkgpath))
+                seen.add(pkgpath)
+
+        return entries + self.collect_meta_files(metapath)
+
+    def collect_meta_files(self, metapath):
+        # Include files from the metadata/scripts path
+        # except metadata.yaml which we deal with separately
+        entries = []
+        for root, dirs, files in os.walk(metapath):
+            pkgroot = root[len(metapath)+1:]
+            for f in files:
+                if self.ignore_filename_re.match(f):
+                    continue
+                if f in ("metadata.yaml", "manifest", "deleted"):
+                    continue
+                realpath = os.path.join(root, f)
+                pkgpath = os.path.join(".olut", pkgroot, f)
+                entries.append((realpath, pkgpath))
+        return entries
+
+    def get_manifest(self, entries, cache=None):
+        """Return manifest rows of (pkgpath, size, mode, sha256, mtime) for
+        a list of (realpath, pkgpath). With a build cache digests are only
+        computed for files whose size, mtime or inode changed."""
+        manifest = []
+        files = cache["files"] if cache else {}
+        for realpath, pkgpath in entries:
+            st = os.lstat(realpath)
+            size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+            key = [size, st.st_mtime, st.st_ino]
+            cached = files.get(pkgpath)
+            if cached and cached[:3] == key:
+                digest = cached[3]
+            else:
+                digest = path_digest(realpath)
+                files[pkgpath] = key + [digest]
+            manifest.append((pkgpath, size, st.st_mode, digest, int(st.st_mtime)))
+        if cache:
+            paths = set(x[1] for x in entries)
+            for pkgpath in list(files):
+                if pkgpath not in paths:
+                    del files[pkgpath]
+        return manifest
+
+    def load_base_manifest(self, base):
+        """Load the metadata and a {pkgpath: (mode, sha256)} map for the
+        base of a delta which is either a package or the .olut/manifest of
+        an installed version"""
+        if os.path.basename(base) == "manifest":
+            root = os.path.dirname(os.path.dirname(base))
+            with open(os.path.join(os.path.dirname(base), "metadata.yaml"), "r") as fp:
+                meta = yaml.load(fp)
+            with open(base, "rb") as fp:
+                manifest = parse_manifest(fp.read())
+            if any(row[3] is None for row in manifest):
+                manifest = [row[:3] + (path_digest(os.path.join(root, row[0])), row[4]) for row in manifest]
+        else:
+            meta = self.get_package_info(base)
+            manifest = self.get_package_manifest(base)
+            if not manifest or any(row[3] is None for row in manifest):
+                manifest = self.get_package_digests(base)
+        return meta, dict((row[0], (row[2], row[3])) for row in manifest)
+
+    def get_package_digests(self, path):
+        """Return manifest rows for a package by reading all of it"""
+        manifest = []
+        with open_tar_reader(path) as fp:
+            for member in fp:
+                if member.name.startswith(".olut/"):
+                    continue
+                if member.isreg():
+                    digest = file_digest(fp.extractfile(member))
+                elif member.issym():
+                    digest = hashlib.sha256(member.linkname).hexdigest()
+                else:
+                    continue
+                mode = member.mode | (stat.S_IFREG if member.isreg() else stat.S_IFLNK)
+                manifest.append((member.name, member.size, mode, digest, int(member.mtime)))
+        return manifest
+
+    def apply_delta(self, meta, install_path):
+        """Fill in the files of a delta package that are unchanged from its
+        base version by hardlinking them from the installed base. The
+        linked files are hashed so a base that was changed since it was
+        installed isn't carried over."""
+        base_path = os.path.join(self.install_path, meta["name"], str(meta["delta"]["base_version"]))
+        with open(os.path.join(install_path, ".olut", "manifest"), "rb") as fp:
+            manifest = parse_manifest(fp.read())
+        linked = []
+        for row in manifest:
+            pkgpath, size, mode, digest, mtime = row
+            target = os.path.join(install_path, pkgpath)
+            if os.path.lexists(target):
+                continue
+            source = os.path.join(base_path, pkgpath)
+            target_dir = os.path.dirname(target)
+            if not os.path.exists(target_dir):
+                os.makedirs(target_dir)
+            if stat.S_ISLNK(mode):
+                os.symlink(os.readlink(source), target)
+            else:
+                os.link(source, target)
+            linked.append(row)
+        self.log.info("Linked %d unchanged files from version %s", len(linked), meta["delta"]["base_version"])
+        self.check_manifest(install_path, manifest)
+        problems = self.check_files(install_path, linked)
+        if problems:
+            for problem in problems:
+                self.log.error(problem)
+            raise Exception("Files linked from version %s of %s don't match the manifest" % (
+                meta["delta"]["base_version"], meta["name"]))
+
+    def check_manifest(self, path, manifest):
+        """Check that every file in the manifest exists in path with the
+        right type and size"""
+        for pkgpath, size, mode, digest, mtime in manifest:
+            try:
+                st = os.lstat(os.path.join(path, pkgpath))
+            except OSError:
+                raise Exception("Missing file %s" % pkgpath)
+            if stat.S_IFMT(st.st_mode) != stat.S_IFMT(mode):
+                raise Exception("File %s has the wrong type" % pkgpath)
+            if stat.S_ISREG(mode) and st.st_size != size:
+                raise Exception("File %s has size %d instead of %d" % (pkgpath, st.st_size, size))
+
+    def _add_string(self, fp, eti, name, data, mtime=None):
+        ti = tarfile.TarInfo(name)
+        ti.size = len(data)
+        ti.mtime = time.time() if mtime is None else mtime
+        for k in ("uid", "gid", "uname", "gname"):
+            setattr(ti, k, getattr(eti, k))
+        fp.addfile(ti, StringIO(data))
+
     def install(self, pkgpath, activate=False, metaoverride=None):
-        if not os.path.exists(self.install_path):
-            os.makedirs(self.install_path)
-        with closing(tarfile.open(pkgpath, "r")) as fp:
-            meta = yaml.load(fp.extractfile(".olut/metadata.yaml"))
-            if metaoverride:
-                meta.update(metaoverride)
-            self.log.info("Installing version %s of %s", meta["version"], meta["name"])
-            meta["install_date"] = datetime.datetime.now()
+        """Install a package from a path, a file object or - for stdin.
+        Returns the installed version's metadata."""
+        with self.timed("install", package=pkgpath if isinstance(pkgpath, basestring) else "-") as t:
+            meta = self._install(pkgpath, activate, metaoverride)
+            t.update(name=meta["name"], version=str(meta["version"]))
+        return meta
+
+    def _install(self, pkgpath, activate, metaoverride):
+        makedirs(self.install_path)
+        if self.repository and isinstance(pkgpath, basestring) and pkgpath != "-" \
+                and not os.path.exists(pkgpath):
+            return self.install_from_repository(pkgpath, activate, metaoverride)
+        if pkgpath == "-" or hasattr(pkgpath, "read"):
+            meta, install_path = self.install_stream(
+                sys.stdin if pkgpath == "-" else pkgpath, metaoverride)
+            with self.lock(meta["name"]):
+                self.finish_install(meta, install_path, activate)
+            return meta
+
+        meta = self.get_package_info(pkgpath)
+        if metaoverride:
+            meta.update(metaoverride)
+        with self.lock(meta["name"]):
+            self.check_delta_base(meta)
             install_path = os.path.join(
                 self.install_path,
                 meta['name'],
                 str(meta['version']),
             )
-            os.makedirs(install_path)
-            # Don't use fp.extractall as it doesn't check for filenames
-            # starting with / or ..
-            for name in fp.getnames():
-                if name.startswith("..") or name.startswith("/"):
-                    self.log.warning("Ignoring invalid file %s", name)
-                    continue
-                fp.extract(name, install_path)
-        with open(os.path.join(install_path, ".olut/metadata.yaml"), "w") as fp:
+            if os.path.exists(install_path):
+                raise Exception("Version %s of %s is already installed" % (meta["version"], meta["name"]))
+            self.check_space(pkgpath, meta)
+            self.log.info("Installing version %s of %s", meta["version"], meta["name"])
+            meta["install_date"] = datetime.datetime.now()
+            # Extract into a staging dir and rename it into place once
+            # it's complete so a failed install leaves nothing behind
+            staging_path = tempfile.mkdtemp(prefix=".staging-", dir=self.install_path)
+            try:
+                os.chmod(staging_path, 0755)
+                with open_tar_reader(pkgpath) as fp:
+                    self.extract_members(fp, staging_path)
+                if meta.get("layers"):
+                    self.install_layers(meta, staging_path, os.path.dirname(os.path.abspath(pkgpath)))
+                if "delta" in meta:
+                    self.apply_delta(meta, staging_path)
+                self.check_staging(staging_path)
+                self.commit_staging(meta, staging_path, install_path)
+            except:
+                shutil.rmtree(staging_path, ignore_errors=True)
+                raise
+            self.finish_install(meta, install_path, activate)
+        return meta
+
+    def check_space(self, pkgpath, meta):
+        """Raise if a package's files won't fit in the free space under
+        install_path. Sizes come from the manifest leaving out files that
+        will be hardlinked from an installed delta base or layer."""
+        manifest = self.get_package_manifest(pkgpath)
+        if manifest is None:
+            return
+        linked = set()
+        if "delta" in meta:
+            base_manifest_path = os.path.join(self.install_path, meta["name"],
+                str(meta["delta"]["base_version"]), ".olut", "manifest")
+            if os.path.exists(base_manifest_path):
+                with open(base_manifest_path, "rb") as fp:
+                    base = dict((row[0], (row[2], row[3])) for row in parse_manifest(fp.read()) if row[3])
+                linked.update(row[0] for row in manifest if base.get(row[0]) == (row[2], row[3]))
+        for layer in meta.get("layers") or []:
+            if os.path.exists(os.path.join(self.install_path, self.LAYERS_DIRNAME, layer["hash"])):
+                matcher = PathMatcher(layer.get("paths", []))
+                linked.update(row[0] for row in manifest if matcher.match_tree(row[0], names=False))
+        st = os.statvfs(self.install_path)
+        block = st.f_frsize or 4096
+        # Every file takes up at least its size rounded up to a block
+        needed = sum((row[1] + block - 1) // block * block
+            for row in manifest if row[0] not in linked and stat.S_ISREG(row[2]))
+        available = st.f_bavail * st.f_frsize
+        if needed > available:
+            raise Exception("Not enough space to install version %s of %s: %d bytes needed, %d available" % (
+                meta["version"], meta["name"], needed, available))
+
+    def check_staging(self, staging_path):
+        """Check an extracted package against its manifest before it's
+        renamed into place"""
+        manifest_path = os.path.join(staging_path, ".olut", "manifest")
+        if not os.path.exists(manifest_path):
+            return
+        with open(manifest_path, "rb") as fp:
+            self.check_manifest(staging_path, parse_manifest(fp.read()))
+
+    def commit_staging(self, meta, staging_path, install_path):
+        """Write the installed metadata into a fully extracted staging dir
+        and rename it to install_path. In durable mode everything is
+        flushed to disk first, with a single syncfs of the filesystem
+        where that's available or else fsyncs of all the files in a
+        batch, and the rename is fsynced after."""
+        with open(os.path.join(staging_path, ".olut", "metadata.yaml"), "w") as fp:
             yaml.dump(meta, fp, default_flow_style=False)
+        if self.durable:
+            with self.timed("install.sync") as t:
+                t["method"] = "syncfs" if syncfs(staging_path) else "fsync"
+                if t["method"] == "fsync":
+                    self.fsync_tree(staging_path)
+        makedirs(os.path.dirname(install_path))
+        os.rename(staging_path, install_path)
+        if self.durable:
+            fsync_path(os.path.dirname(install_path))
+
+    def fsync_tree(self, path):
+        """fsync every file and directory under path on a thread pool"""
+        paths = []
+        for root, dirs, files in os.walk(path):
+            paths.append(root)
+            paths.extend(os.path.join(root, f) for f in files if not os.path.islink(os.path.join(root, f)))
+        pool = ThreadPool(multiprocessing.cpu_count() * 2)
+        try:
+            pool.map(fsync_path, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    def finish_install(self, meta, install_path, activate=False):
+        self.update_index(meta['name'], str(meta['version']), meta)
         self.runscript(meta['name'], str(meta['version']), "install")
         if activate:
-            self.activate(meta["name"], meta["version"])
+            self.activate(meta["name"], str(meta["version"]))
+        removed = self.apply_retention(meta["name"],
+            self.keep_versions if self.keep_versions is not None else meta.get("keep_versions"),
+            self.keep_days if self.keep_days is not None else meta.get("keep_days"),
+            installed=str(meta["version"]))
+        if removed:
+            self.collect_garbage()
+
+    def install_many(self, pkgpaths, activate=False, metaoverride=None, jobs=None):
+        """Install several packages in parallel on a thread pool. Packages
+        are activated at the end in dependency order (the depends list in
+        their metadata) if activate is True."""
+        makedirs(self.install_path)
+        def install_one(pkgpath):
+            try:
+                return self.install(pkgpath, metaoverride=metaoverride), None
+            except Exception, exc:
+                self.log.exception("Failed to install %s", pkgpath)
+                return None, exc
+        pool = ThreadPool(jobs or min(len(pkgpaths), multiprocessing.cpu_count() * 2) or 1)
+        try:
+            results = pool.map(install_one, pkgpaths)
+        finally:
+            pool.close()
+            pool.join()
+        failed = [pkgpath for pkgpath, (meta, exc) in zip(pkgpaths, results) if exc]
+        if failed:
+            raise Exception("Failed to install %s" % ", ".join(failed))
+        metas = [meta for meta, exc in results]
+        if activate:
+            for meta in sort_dependencies(metas):
+                self.activate(meta["name"], str(meta["version"]))
+        return metas
+
+    def install_stream(self, fileobj, metaoverride=None):
+        """Extract a package from a non-seekable stream in one pass. The
+        name and version aren't known until the metadata has been read so
+        the package is extracted into a staging dir which is renamed into
+        place once the stream ends. Returns (meta, install_path)."""
+        staging_path = tempfile.mkdtemp(prefix=".staging-", dir=self.install_path)
+        try:
+            os.chmod(staging_path, 0755)
+            self.log.info("Installing from stream")
+            with open_tar_stream(fileobj) as fp:
+                self.extract_members(fp, staging_path)
+            with open(os.path.join(staging_path, ".olut", "metadata.yaml"), "r") as fp:
+                meta = yaml.load(fp)
+            if metaoverride:
+                meta.update(metaoverride)
+            self.log.info("Installing version %s of %s", meta["version"], meta["name"])
+            meta["install_date"] = datetime.datetime.now()
+            with self.lock(meta["name"]):
+                self.check_delta_base(meta)
+                if meta.get("layers"):
+                    self.install_layers(meta, staging_path)
+                if "delta" in meta:
+                    self.apply_delta(meta, staging_path)
+                install_path = os.path.join(
+                    self.install_path,
+                    meta['name'],
+                    str(meta['version']),
+                )
+                if os.path.exists(install_path):
+                    raise Exception("Version %s of %s is already installed" % (meta["version"], meta["name"]))
+                self.check_staging(staging_path)
+                self.commit_staging(meta, staging_path, install_path)
+        except:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            raise
+        return meta, install_path
+
+    def install_from_repository(self, name_spec, activate=False, metaoverride=None):
+        """Install name[@spec] resolved through the repository index.
+        Packages in an http repository are downloaded to a temporary dir
+        along with any layers that aren't installed yet."""
+        entry = self.resolve(name_spec)
+        if not self.repository.startswith(("http://", "https://")):
+            return self._install(os.path.join(self.repository, entry["file"]), activate, metaoverride)
+        download_path = tempfile.mkdtemp(prefix=".download-", dir=self.install_path)
+        try:
+            self.fetch_package(entry, download_path)
+            return self._install(os.path.join(download_path, entry["file"]), activate, metaoverride)
+        finally:
+            shutil.rmtree(download_path, ignore_errors=True)
+
+    def resolve(self, name_spec):
+        """Return the repository index entry for name[@spec]. The spec is
+        a version, a branch (its newest build) or anything find_versions
+        accepts with builds ordered newest first. Defaults to the newest."""
+        name, _, ver_spec = name_spec.partition("@")
+        builds = self.load_repository_index(self.repository).get(name)
+        if not builds:
+            raise Exception("Package %s not found in %s" % (name, self.repository))
+        ver_spec = ver_spec or "0"
+        versions = sorted(builds.iteritems(), key=lambda x:x[1]["build_date"], reverse=True)
+        if ver_spec in builds:
+            ver = ver_spec
+        elif any(entry.get("branch") == ver_spec for entry in builds.itervalues()):
+            ver = [ver for ver, entry in versions if entry.get("branch") == ver_spec][0]
+        else:
+            matched = match_versions(versions, ver_spec, self.get_current_version(name))
+            if not matched:
+                raise Exception("Could not find version matching %s for package %s in %s" % (
+                    ver_spec, name, self.repository))
+            ver = matched[0]
+        self.log.info("Resolved %s to version %s", name_spec, ver)
+        return builds[ver]
+
+    def fetch_package(self, entry, path):
+        """Download a package and the layers it needs from an http
+        repository into path checking the package's sha256"""
+        files = [entry["file"]] + [
+            layer["file"] for layer in entry.get("layers") or []
+            if not os.path.exists(os.path.join(self.install_path, self.LAYERS_DIRNAME, layer["hash"]))]
+        for name in files:
+            url = "%s/%s" % (self.repository.rstrip("/"), urllib.quote(name))
+            self.log.info("Downloading %s", url)
+            src = urllib2.urlopen(url)
+            digest = hashlib.sha256()
+            with open(os.path.join(path, name), "wb") as fp:
+                for chunk in iter(lambda: src.read(1024*1024), ""):
+                    digest.update(chunk)
+                    fp.write(chunk)
+            if name == entry["file"] and digest.hexdigest() != entry["sha256"]:
+                raise Exception("Checksum mismatch for %s" % url)
+
+    def load_repository_index(self, repository):
+        """Load a repository index which maps package name to {version:
+        entry} where entry holds the file, size, sha256, scm branch,
+        revision and tag, build_date and layer archives of a build"""
+        try:
+            if repository.startswith(("http://", "https://")):
+                fp = urllib2.urlopen("%s/%s" % (repository.rstrip("/"), self.REPOSITORY_INDEX_FILENAME))
+            else:
+                fp = open(os.path.join(repository, self.REPOSITORY_INDEX_FILENAME), "rb")
+        except urllib2.HTTPError, e:
+            if e.code != 404:
+                raise
+            return {}
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        try:
+            return json.load(fp, object_hook=_json_object_hook)
+        finally:
+            fp.close()
+
+    def save_repository_index(self, repo_path, index):
+        fd, tmp_path = tempfile.mkstemp(prefix=".index", dir=repo_path)
+        with os.fdopen(fd, "wb") as fp:
+            json.dump(index, fp, default=_json_default, separators=(",", ":"), sort_keys=True)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, os.path.join(repo_path, self.REPOSITORY_INDEX_FILENAME))
+
+    def index_package(self, repo_path, pkgpath, meta=None):
+        """Add or replace a package's entry in the index of the repository
+        in repo_path"""
+        meta = meta or self.get_package_info(pkgpath)
+        with self.lock_repository(repo_path):
+            index = self.load_repository_index(repo_path)
+            index.setdefault(meta["name"], {})[str(meta["version"])] = self.get_repository_entry(pkgpath, meta)
+            self.save_repository_index(repo_path, index)
+        self.log.info("Added version %s of %s to the repository index", meta["version"], meta["name"])
+
+    def index_repository(self, repo_path):
+        """Create or rebuild the index of every package in repo_path"""
+        extensions = tuple("." + get_extension(x) for x in COMPRESSION_TYPES)
+        index = {}
+        for name in sorted(os.listdir(repo_path)):
+            if name.startswith(".") or not name.endswith(extensions) \
+                    or ".layer." in name or ".delta." in name:
+                continue
+            pkgpath = os.path.join(repo_path, name)
+            meta = self.get_package_info(pkgpath)
+            index.setdefault(meta["name"], {})[str(meta["version"])] = self.get_repository_entry(pkgpath, meta)
+        with self.lock_repository(repo_path):
+            self.save_repository_index(repo_path, index)
+        self.log.info("Indexed %d packages in %s", sum(len(x) for x in index.itervalues()), repo_path)
+
+    def get_repository_entry(self, pkgpath, meta):
+        scm = meta.get("scm") or {}
+        with open(pkgpath, "rb") as fp:
+            digest = file_digest(fp)
+        entry = dict(
+            file = os.path.basename(pkgpath),
+            size = os.path.getsize(pkgpath),
+            sha256 = digest,
+            build_date = meta["build_date"],
+            branch = scm.get("branch"),
+            revision = scm.get("revision"),
+            tag = scm.get("tag"),
+        )
+        if meta.get("layers"):
+            entry["layers"] = [dict(file=layer["file"], hash=layer["hash"]) for layer in meta["layers"]]
+        return entry
+
+    @contextmanager
+    def lock_repository(self, repo_path):
+        """Lock a repository's index so concurrent builds into it don't
+        lose entries"""
+        with open(os.path.join(repo_path, ".index.lock"), "a") as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def install_layers(self, meta, install_path, pkgdir=None):
+        """Hardlink the files of each layer of a layered package into the
+        version dir from install_path/.layers/<hash>. Layers that aren't
+        there yet are extracted from the layer archives in pkgdir (the
+        directory holding the package)."""
+        layers_path = os.path.join(self.install_path, self.LAYERS_DIRNAME)
+        for layer in meta["layers"]:
+            layer_path = os.path.join(layers_path, layer["hash"])
+            # gc takes the same lock before removing a layer
+            with self.lock(".layer-%s" % layer["hash"]):
+                if os.path.exists(layer_path):
+                    self.log.info("Layer %s is already installed", layer["name"])
+                else:
+                    self.extract_layer(meta, layer, layer_path, pkgdir)
+                self.link_tree(layer_path, install_path)
+
+    def extract_layer(self, meta, layer, layer_path, pkgdir):
+        archive_path = os.path.join(pkgdir, layer["file"]) if pkgdir else None
+        if not archive_path or not os.path.exists(archive_path):
+            raise Exception("Layer %s of %s isn't installed and %s wasn't found next to the package" % (
+                layer["name"], meta["name"], layer["file"]))
+        self.log.info("Installing layer %s from %s", layer["name"], archive_path)
+        makedirs(os.path.dirname(layer_path))
+        staging_path = tempfile.mkdtemp(prefix=".staging-", dir=os.path.dirname(layer_path))
+        try:
+            os.chmod(staging_path, 0755)
+            with open_tar_reader(archive_path) as fp:
+                self.extract_members(fp, staging_path)
+            os.rename(staging_path, layer_path)
+        except:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            raise
+
+    def link_tree(self, source, target):
+        """Hardlink every file under source into the same path under
+        target. Symlinks are copied."""
+        for root, dirs, files in os.walk(source):
+            target_root = os.path.join(target, root[len(source)+1:])
+            makedirs(target_root)
+            for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target_root, name))
+                else:
+                    os.link(path, os.path.join(target_root, name))
+
+    @contextmanager
+    def timed(self, event, **fields):
+        """Time the body of a with block and emit it as a timing event.
+        The yielded dict can be used to add fields to the event."""
+        start = time.time()
+        try:
+            yield fields
+        except Exception, exc:
+            fields["error"] = str(exc)
+            self.emit_timing(event, time.time() - start, fields)
+            raise
+        self.emit_timing(event, time.time() - start, fields)
+
+    def emit_timing(self, event, duration, fields):
+        """Write a timing event as a line of JSON to the timings stream.
+        Throughput is added for events with files or bytes_in counts."""
+        if not self.timings:
+            return
+        record = dict(fields, event=event, time=time.time(), duration=round(duration, 6))
+        if duration > 0:
+            if "files" in fields:
+                record["files_per_sec"] = round(fields["files"] / duration, 1)
+            if "bytes_in" in fields:
+                record["bytes_per_sec"] = round(fields["bytes_in"] / duration, 1)
+        line = json.dumps(record, sort_keys=True, default=str) + "\n"
+        with self._timings_lock:
+            self.timings.write(line)
+            self.timings.flush()
+
+    @contextmanager
+    def lock(self, name):
+        """Hold an exclusive lock on name (a package name) that is shared
+        between threads and olut processes. Reentrant within a thread."""
+        held = self._locks.__dict__.setdefault("held", set())
+        if name in held:
+            yield
+            return
+        locks_path = os.path.join(self.install_path, self.LOCKS_DIRNAME)
+        makedirs(locks_path)
+        with open(os.path.join(locks_path, "%s.lock" % name), "a") as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            held.add(name)
+            try:
+                yield
+            finally:
+                held.discard(name)
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def check_delta_base(self, meta):
+        if "delta" not in meta:
+            return
+        base_path = os.path.join(self.install_path, meta["name"], str(meta["delta"]["base_version"]))
+        if not os.path.exists(base_path):
+            raise Exception("Delta package requires version %s of %s to be installed" % (
+                meta["delta"]["base_version"], meta["name"]))
     
+    def extract_members(self, fp, path):
+        """Extract all members of the open tarfile fp into path in a single
+        pass in archive order. Returns a (files, bytes) tuple."""
+        stats = dict(files=0, bytes=0, linked=0)
+        digests = {}
+        def safe_members():
+            # fp.extractall alone doesn't check for filenames starting
+            # with / or .. so filter them out as we go
+            for member in fp:
+                if member.name.startswith("..") or member.name.startswith("/"):
+                    self.log.warning("Ignoring invalid file %s", member.name)
+                    continue
+                if member.isreg():
+                    stats["files"] += 1
+                    stats["bytes"] += member.size
+                    if self.dedup and member.name == ".olut/manifest":
+                        # The manifest comes before the files so its digests
+                        # let objects already in the store be linked without
+                        # reading them. It can't be read and then extracted
+                        # on a stream so write it out here.
+                        data = fp.extractfile(member).read()
+                        digests.update((row[0], row[3]) for row in parse_manifest(data))
+                        makedirs(os.path.join(path, ".olut"))
+                        with open(os.path.join(path, member.name), "wb") as mfp:
+                            mfp.write(data)
+                        continue
+                    # Files under .olut/ (metadata.yaml in particular) get
+                    # rewritten after install so are never shared
+                    if self.dedup and not member.name.startswith(".olut/"):
+                        target = os.path.join(path, member.name)
+                        if not self.link_object(fp, member, target, digests.get(member.name)):
+                            stats["linked"] += 1
+                        continue
+                yield member
+        start = time.time()
+        # extractall extracts directories with a safe mode and fixes up
+        # their owner, mtime and permissions in one pass at the end
+        with self.timed("install.extract", dedup=self.dedup) as t:
+            fp.extractall(path, members=safe_members())
+            t.update(files=stats["files"], bytes_in=stats["bytes"], linked=stats["linked"])
+        elapsed = max(time.time() - start, 0.000001)
+        self.log.info("Extracted %d files (%d bytes) in %.2fs (%.1f files/s, %.2f MB/s)",
+            stats["files"], stats["bytes"], elapsed,
+            stats["files"] / elapsed, stats["bytes"] / elapsed / 1048576)
+        if self.dedup:
+            self.log.info("Linked %d files already in the object store", stats["linked"])
+        return stats["files"], stats["bytes"]
+
+    def link_object(self, fp, member, target, digest=None):
+        """Hash a regular file member into the content addressed object
+        store and hardlink target to it. If the member's digest is known
+        from the manifest and the object exists it isn't read at all.
+        Returns True if the object had to be written or False if it was
+        already in the store."""
+        objects_path = os.path.join(self.install_path, self.OBJECTS_DIRNAME)
+        # Hardlinks share permissions so they're part of the key
+        mode = member.mode & 07777
+        target_dir = os.path.dirname(target)
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+        if os.path.lexists(target):
+            os.unlink(target)
+        if digest:
+            try:
+                os.link(os.path.join(objects_path, digest[:2], "%s-%o" % (digest[2:], mode)), target)
+            except OSError:
+                pass
+            else:
+                return False
+
+        src = fp.extractfile(member)
+        data = tmp_path = None
+        digest = hashlib.sha256()
+        if member.size <= self.DEDUP_MEMORY_LIMIT:
+            data = src.read()
+            digest.update(data)
+        else:
+            if not os.path.exists(objects_path):
+                os.makedirs(objects_path)
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=objects_path)
+            with os.fdopen(fd, "wb") as tmpfp:
+                for chunk in iter(lambda: src.read(1024*1024), ""):
+                    digest.update(chunk)
+                    tmpfp.write(chunk)
+        digest = digest.hexdigest()
+        obj_path = os.path.join(objects_path, digest[:2], "%s-%o" % (digest[2:], mode))
+        try:
+            os.link(obj_path, target)
+        except OSError:
+            # Not in the store yet (or just garbage collected)
+            pass
+        else:
+            if tmp_path:
+                os.unlink(tmp_path)
+            return False
+
+        if not os.path.exists(os.path.dirname(obj_path)):
+            os.makedirs(os.path.dirname(obj_path))
+        if tmp_path is None:
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=objects_path)
+            with os.fdopen(fd, "wb") as tmpfp:
+                tmpfp.write(data)
+        os.chmod(tmp_path, mode)
+        os.utime(tmp_path, (member.mtime, member.mtime))
+        # Link the target first so the object never sits in the store
+        # with a link count of 1 where gc_objects (which takes no lock)
+        # would remove it. rename is atomic so a concurrent install of
+        # the same object wins harmlessly.
+        os.link(tmp_path, target)
+        os.rename(tmp_path, obj_path)
+        return True
+
+    def gc_objects(self):
+        """Remove objects from the store that are no longer linked from
+        any installed version. The link count is the reference count."""
+        objects_path = os.path.join(self.install_path, self.OBJECTS_DIRNAME)
+        if not os.path.exists(objects_path):
+            return
+        removed = 0
+        for root, dirs, files in os.walk(objects_path):
+            for f in files:
+                path = os.path.join(root, f)
+                if os.lstat(path).st_nlink == 1 and not f.startswith(".tmp"):
+                    os.unlink(path)
+                    removed += 1
+        self.log.info("Removed %d unused objects from the store", removed)
+
     def uninstall(self, pkg, ver_spec):
+        with self.lock(pkg):
+            self._uninstall(pkg, ver_spec)
+        self.collect_garbage()
+
+    def _uninstall(self, pkg, ver_spec):
         current_ver = self.get_current_version(pkg)
         versions = self.find_versions(pkg, ver_spec)
         
@@ -154,11 +1087,131 @@ class Olut(object):
             ver_path = os.path.join(pkg_path, ver)
             self.log.info("Uninstalling version %s of %s", ver, pkg)
             if os.path.exists(ver_path):
-                shutil.rmtree(ver_path)
+                self.trash(ver_path)
+            self.update_index(pkg, ver)
     
         if not self.get_versions(pkg):
             self.log.info("Cleaning up package %s as it has no installe versions", pkg)
-            shutil.rmtree(pkg_path)
+            self.trash(pkg_path)
+            self.update_index(pkg)
+
+    def apply_retention(self, pkg, keep_versions=None, keep_days=None, installed=None):
+        """Uninstall old versions of pkg. A version is kept if it is one of
+        the keep_versions newest, was installed less than keep_days ago or
+        is the current or the just installed version. Returns the
+        uninstalled versions."""
+        if keep_versions is None and keep_days is None:
+            return []
+        current_ver = self.get_current_version(pkg)
+        cutoff = None
+        if keep_days is not None:
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=keep_days)
+        remove = []
+        for i, (ver, meta) in enumerate(self.get_versions(pkg)):
+            if ver in (current_ver, installed):
+                continue
+            if keep_versions is not None and i < keep_versions:
+                continue
+            if cutoff is not None and meta["install_date"] > cutoff:
+                continue
+            remove.append(ver)
+        for ver in remove:
+            self.log.info("Uninstalling version %s of %s by retention policy", ver, pkg)
+            self.trash(os.path.join(self.install_path, pkg, ver))
+            self.update_index(pkg, ver)
+        return remove
+
+    def trash(self, path):
+        """Move path into the trash to be deleted later by empty_trash.
+        This is a rename so it's instant and atomic."""
+        trash_path = os.path.join(self.install_path, self.TRASH_DIRNAME)
+        makedirs(trash_path)
+        dest_path = tempfile.mkdtemp(prefix=os.path.basename(path) + "-", dir=trash_path)
+        os.rename(path, os.path.join(dest_path, os.path.basename(path)))
+
+    def empty_trash(self, jobs=None):
+        """Delete everything in the trash removing the top level entries of
+        each trashed directory in parallel"""
+        trash_path = os.path.join(self.install_path, self.TRASH_DIRNAME)
+        if not os.path.exists(trash_path):
+            return
+        # Each entry is a directory holding one trashed version (or
+        # package) dir, remove that dir's children in parallel
+        paths = []
+        for name in os.listdir(trash_path):
+            entry_path = os.path.join(trash_path, name)
+            for trashed in os.listdir(entry_path):
+                trashed_path = os.path.join(entry_path, trashed)
+                if os.path.isdir(trashed_path) and not os.path.islink(trashed_path):
+                    paths.extend(os.path.join(trashed_path, x) for x in os.listdir(trashed_path))
+        def remove(path):
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.lexists(path):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        with self.timed("empty_trash", paths=len(paths)):
+            pool = ThreadPool(jobs or multiprocessing.cpu_count() * 2)
+            try:
+                pool.map(remove, paths)
+            finally:
+                pool.close()
+                pool.join()
+            for name in os.listdir(trash_path):
+                shutil.rmtree(os.path.join(trash_path, name), ignore_errors=True)
+
+    def gc_layers(self):
+        """Remove installed layers no installed version uses"""
+        layers_path = os.path.join(self.install_path, self.LAYERS_DIRNAME)
+        if not os.path.exists(layers_path):
+            return
+        used = set()
+        for info in self.get_installed_list().itervalues():
+            for ver, meta in info["versions"]:
+                used.update(layer["hash"] for layer in meta.get("layers") or [])
+        removed = 0
+        for name in os.listdir(layers_path):
+            if name.startswith(".") or name in used:
+                continue
+            with self.lock(".layer-%s" % name):
+                shutil.rmtree(os.path.join(layers_path, name), ignore_errors=True)
+            removed += 1
+        self.log.info("Removed %d unused layers", removed)
+
+    def gc_staging(self):
+        """Remove staging and download dirs left behind by installs that
+        were killed"""
+        cutoff = time.time() - self.STAGING_MAX_AGE
+        for parent in (self.install_path, os.path.join(self.install_path, self.LAYERS_DIRNAME)):
+            if not os.path.exists(parent):
+                continue
+            for name in os.listdir(parent):
+                path = os.path.join(parent, name)
+                if name.startswith((".staging-", ".download-")) and os.lstat(path).st_mtime < cutoff:
+                    self.log.info("Removing stale %s", path)
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def gc(self, jobs=None):
+        """Finish deleting trashed versions, remove unused objects and
+        layers and stale staging dirs"""
+        self.empty_trash(jobs)
+        self.gc_objects()
+        self.gc_layers()
+        self.gc_staging()
+
+    def collect_garbage(self):
+        """Run gc in a detached background process if background_gc is
+        set, otherwise run it inline"""
+        if not self.background_gc:
+            self.gc()
+            return
+        self.log.info("Removing uninstalled versions in the background")
+        subprocess.Popen(
+            [sys.executable, "-m", "olut.command", "--quiet", "--path", self.install_path, "gc"],
+            close_fds=True, preexec_fn=os.setsid,
+            stdin=open(os.devnull), stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
     
     def list(self):
         packages = self.get_installed_list()
@@ -178,7 +1231,11 @@ class Olut(object):
         info = self.get_package_info(pkg)
         yaml.dump(info, sys.stdout, default_flow_style=False)
     
-    def activate(self, pkg, ver, revert=True):
+    def activate(self, pkg, ver, revert=True, environ=None):
+        with self.lock(pkg):
+            self._activate(pkg, ver, revert, environ)
+
+    def _activate(self, pkg, ver, revert=True, environ=None):
         versions = self.find_versions(pkg, ver)
         if not versions:
             raise Exception("Could not find version matching %s for package %s" % (ver, pkg))
@@ -192,19 +1249,55 @@ class Olut(object):
 
         current_path = os.path.join(self.install_path, pkg, "current")
         pkg_path = os.path.join(self.install_path, pkg, ver)
-        if os.path.lexists(current_path):
-            self.deactivate(pkg)
+        # The deactivate script runs while current still points at the old
+        # version, and current is replaced with a rename so it always exists
+        start = time.time()
+        if cur_ver and os.path.exists(current_path):
+            self.log.info("Deactivating current version %s of %s", cur_ver, pkg)
+            self.runscript(pkg, cur_ver, "deactivate", environ)
+        deactivate_time = time.time() - start
         self.log.info("Activating version %s of %s", ver, pkg)
         try:
-            os.symlink(pkg_path, current_path)
-            self.runscript(pkg, ver, "activate")
+            start = time.time()
+            self.switch_current(pkg, pkg_path)
+            switch_time = time.time() - start
+            start = time.time()
+            self.runscript(pkg, ver, "activate", environ)
+            activate_time = time.time() - start
         except:
             if revert and cur_ver:
                 self.log.error("Exception while activating.. reverting to %s", cur_ver)
-                self.activate(pkg, ver, revert=False)
+                self.activate(pkg, cur_ver, revert=False, environ=environ)
             raise
+        self.log.info("Deactivate script took %.3fs, switch %.6fs, activate script %.3fs",
+            deactivate_time, switch_time, activate_time)
+        self.emit_timing("activate", deactivate_time + switch_time + activate_time, dict(
+            name = pkg,
+            version = ver,
+            deactivate_script = deactivate_time,
+            switch = switch_time,
+            activate_script = activate_time,
+        ))
 
-    def deactivate(self, pkg):
+    def switch_current(self, pkg, pkg_path):
+        """Atomically point the current symlink of pkg at pkg_path by
+        creating it under a temporary name and renaming it over current"""
+        current_path = os.path.join(self.install_path, pkg, "current")
+        tmp_path = "%s.tmp-%d" % (current_path, os.getpid())
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        os.symlink(pkg_path, tmp_path)
+        try:
+            os.rename(tmp_path, current_path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def deactivate(self, pkg, environ=None):
+        with self.lock(pkg):
+            self._deactivate(pkg, environ)
+
+    def _deactivate(self, pkg, environ=None):
         current_path = os.path.join(self.install_path, pkg, "current")
         if not os.path.exists(current_path):
             if os.path.lexists(current_path):
@@ -215,74 +1308,205 @@ class Olut(object):
             self.log.info("No current version")
             return
         self.log.info("Deactivating current version %s of %s", current_ver, pkg)
-        self.runscript(pkg, current_ver, "deactivate")
+        self.runscript(pkg, current_ver, "deactivate", environ)
         if os.path.exists(current_path):
             os.unlink(current_path)
 
-    def runscript(self, pkg, ver, script):
+    def runscript(self, pkg, ver, script, environ=None):
+        """Run the .olut/<script> hook and any scripts in .olut/<script>.d/
+        (in name order, or all at once if the metadata sets
+        concurrent_scripts). The wall time and exit status of each script
+        is recorded under script_results in the version's metadata.
+        USER, HOME and PATH are taken from environ (the process
+        environment by default)."""
+        environ = os.environ if environ is None else environ
         version_path = os.path.join(self.install_path, pkg, ver)
         script_path = os.path.join(version_path, ".olut", script)
-        if not os.path.exists(script_path):
+        scripts = []
+        if os.path.exists(script_path):
+            scripts.append((script, script_path))
+        if os.path.isdir(script_path + ".d"):
+            for name in sorted(os.listdir(script_path + ".d")):
+                if name.startswith('.') or self.ignore_filename_re.match(name):
+                    continue
+                scripts.append(("%s.d/%s" % (script, name), os.path.join(script_path + ".d", name)))
+        if not scripts:
             return
-        with open(os.path.join(version_path, ".olut", "metadata.yaml"), "r") as fp:
+        meta_path = os.path.join(version_path, ".olut", "metadata.yaml")
+        with open(meta_path, "r") as fp:
             meta = yaml.load(fp)
         env = dict(
             PKG_NAME = pkg,
             PKG_VERSION = ver,
             PKG_PATH = os.path.join(self.install_path, pkg),
             PKG_VERSION_PATH = version_path,
-            USER = os.environ["USER"],
-            HOME = os.environ["HOME"],
-            PATH = os.environ["PATH"],
+            USER = environ["USER"],
+            HOME = environ["HOME"],
+            PATH = environ["PATH"],
         )
         if self.ssh_agent_forward:
             for k in ("SSH_AUTH_SOCK", "SSH_CLIENT", "SSH_CONNECTION", "SSH_TTY"):
-                env[k] = os.getenv(k) or ""
+                env[k] = environ.get(k) or ""
         for k, v in meta.iteritems():
             if isinstance(v, (int, long, basestring)):
                 env["META_%s" % k.upper()] = str(v)
-        proc = subprocess.Popen([script_path], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        out = proc.communicate()[0]
-        if proc.returncode != 0:
-            self.log.error(out)
-            raise Exception("Script %s return a non-zero return code %d" % (script, proc.returncode))
+        timeout = self.script_timeout or meta.get("script_timeout")
+
+        def run(script):
+            name, path = script
+            return (name,) + self.execscript(name, path, env, timeout)
+        if len(scripts) > 1 and meta.get("concurrent_scripts"):
+            pool = ThreadPool(len(scripts))
+            try:
+                results = pool.map(run, scripts)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            self.log.debug(out)
-    
-    def find_versions(self, pkg, ver_spec):
-        if os.path.exists(os.path.join(self.install_path, pkg, ver_spec)):
-            return [ver_spec]
+            results = []
+            for x in scripts:
+                results.append(run(x))
+                if results[-1][1] != 0:
+                    break
+
+        script_results = meta.setdefault("script_results", {})
+        for name, returncode, duration in results:
+            self.log.info("Script %s exited with %d after %.3fs", name, returncode, duration)
+            script_results[name] = dict(
+                returncode = returncode,
+                duration = round(duration, 3),
+                date = datetime.datetime.now(),
+            )
+        # Replace the metadata with a rename so a concurrent reader or a
+        # crash never leaves it partially written
+        fd, tmp_path = tempfile.mkstemp(prefix="metadata.yaml", dir=os.path.dirname(meta_path))
+        with os.fdopen(fd, "wb") as fp:
+            yaml.dump(meta, fp, default_flow_style=False)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, meta_path)
+        self.update_index(pkg, ver, meta)
 
-        versions = self.get_versions(pkg)
-        if ver_spec == "*":
-            return [x[0] for x in versions]
-        elif ver_spec[0] == '@':
-            current_version = self.get_current_version(pkg)
-            if not current_version:
-                raise Exception("Trying to find version '%s' when no current version active for %s", ver_spec, pkg)
-            
-            ver_spec = ver_spec[1:]
-            if len(ver_spec) == 1 or ver_spec[1] in ('-', '+'): # --- / +++
-                offset = -int(ver_spec[0]+(ver_spec[1:] or '1'))
-            else: # -2 / +5
-                offset = -int(ver_spec)
-            
-            current_i = [x[0] for x in versions].index(current_version)
-            return [versions[max(0, current_i+offset)][0]]
-        elif ":" in ver_spec:
-            start, end = ver_spec.split(':')
-            start = int(start) if start else 0
-            end = int(end) if end else len(versions)
-            return [x[0] for x in versions[start:end]]
+        for name, returncode, duration in results:
+            if returncode != 0:
+                raise Exception("Script %s return a non-zero return code %d" % (name, returncode))
 
+    def execscript(self, name, path, env, timeout=None):
+        """Run a script logging its output line by line as it arrives.
+        The script (and its process group) is killed after timeout seconds.
+        Returns (returncode, duration)."""
+        start = time.time()
+        proc = subprocess.Popen([path], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            close_fds=True, preexec_fn=os.setsid)
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+        # Only the tail is kept in memory to log at error level on failure
+        tail = collections.deque(maxlen=self.SCRIPT_TAIL_LINES)
+        logged = lines = 0
         try:
-            ver_i = int(ver_spec)
-        except ValueError:
-            pass
+            for line in iter(proc.stdout.readline, ""):
+                lines += 1
+                line = line.rstrip("\n")
+                tail.append(line)
+                if self.script_log_limit is None or logged < self.script_log_limit:
+                    self.log.debug("%s: %s", name, line)
+                    logged += len(line) + 1
+                    if self.script_log_limit is not None and logged >= self.script_log_limit:
+                        self.log.debug("%s: output truncated after %d bytes", name, logged)
+            proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+            proc.stdout.close()
+        if timed_out:
+            self.log.error("Script %s killed after timeout of %ss", name, timeout)
+        if proc.returncode != 0:
+            self.log.error("\n".join(tail))
+        duration = time.time() - start
+        self.emit_timing("runscript", duration, dict(
+            script = name,
+            returncode = proc.returncode,
+            timed_out = bool(timed_out),
+            output_lines = lines,
+        ))
+        return proc.returncode, duration
+    
+    def verify(self, pkg, ver=None, fast=False, jobs=None):
+        """Check an installed version (the current one by default) against
+        its manifest, hashing files on a thread pool. In fast mode files
+        whose size and mtime match aren't hashed. Returns a list of
+        problems after logging them and raises if there were any."""
+        if ver is None:
+            ver = self.get_current_version(pkg)
+            if not ver:
+                raise Exception("No current version of %s to verify" % pkg)
         else:
-            return [versions[ver_i][0]]
+            versions = self.find_versions(pkg, ver)
+            if not versions:
+                raise Exception("Could not find version matching %s for package %s" % (ver, pkg))
+            ver = versions[0]
+        ver_path = os.path.join(self.install_path, pkg, ver)
+        manifest_path = os.path.join(ver_path, ".olut", "manifest")
+        if not os.path.exists(manifest_path):
+            raise Exception("Version %s of %s was built without a manifest" % (ver, pkg))
+        with open(manifest_path, "rb") as fp:
+            manifest = parse_manifest(fp.read())
+
+        with self.timed("verify", name=pkg, version=ver, files=len(manifest), fast=fast) as t:
+            problems = self.check_files(ver_path, manifest, fast, jobs)
+            t["problems"] = len(problems)
+        for problem in problems:
+            self.log.error(problem)
+        self.log.info("Verified %d files of version %s of %s: %d problems",
+            len(manifest), ver, pkg, len(problems))
+        if problems:
+            raise Exception("Version %s of %s failed verification" % (ver, pkg))
+        return problems
 
-        return []
+    def check_files(self, path, manifest, fast=False, jobs=None):
+        """Check the files under path against manifest rows, hashing them
+        on a thread pool. In fast mode files whose size and mtime match
+        aren't hashed. Returns a sorted list of problems."""
+        def check(row):
+            pkgpath, size, mode, digest, mtime = row
+            file_path = os.path.join(path, pkgpath)
+            try:
+                st = os.lstat(file_path)
+            except OSError:
+                return "%s: missing" % pkgpath
+            if stat.S_IFMT(st.st_mode) != stat.S_IFMT(mode):
+                return "%s: wrong file type" % pkgpath
+            if stat.S_ISREG(mode):
+                if st.st_size != size:
+                    return "%s: size %d instead of %d" % (pkgpath, st.st_size, size)
+                if stat.S_IMODE(st.st_mode) != stat.S_IMODE(mode):
+                    return "%s: mode %o instead of %o" % (pkgpath, stat.S_IMODE(st.st_mode), stat.S_IMODE(mode))
+            if fast and int(st.st_mtime) == mtime:
+                return None
+            if digest and path_digest(file_path) != digest:
+                return "%s: checksum mismatch" % pkgpath
+
+        pool = ThreadPool(jobs or multiprocessing.cpu_count() * 2)
+        try:
+            problems = [x for x in pool.imap_unordered(check, manifest, 64) if x]
+        finally:
+            pool.close()
+            pool.join()
+        return sorted(problems)
+
+    def find_versions(self, pkg, ver_spec):
+        if os.path.exists(os.path.join(self.install_path, pkg, ver_spec)):
+            return [ver_spec]
+        return match_versions(self.get_versions(pkg), ver_spec, self.get_current_version(pkg))
     
     def get_git_ignored(self, path, ignoreunknown):
         p = subprocess.Popen("cd %s; git status --porcelain --ignored" % path, shell=True, stdout=subprocess.PIPE)
@@ -294,7 +1518,16 @@ class Olut(object):
                 or (ignoreunknown and x.split(' ', 1)[0] == "??")
         ]
 
-    def get_git_meta(self, path, ignoreunknown=False):
+    def get_git_meta(self, path, ignoreunknown=False, ignored=True, epoch=None):
+        """Return metadata from the git checkout holding path. Untagged
+        revisions are versioned by branch and the current time, or the
+        epoch timestamp if given."""
+        with self.timed("get_git_meta", path=path) as t:
+            meta = self._get_git_meta(path, ignoreunknown, ignored, epoch)
+            t["exclude_files"] = len(meta.get("exclude_files", []))
+        return meta
+
+    def _get_git_meta(self, path, ignoreunknown, ignored, epoch):
         git_path = None
         origpath = path
         for i in range(self.gitdepth):
@@ -334,9 +1567,13 @@ class Olut(object):
             gitmeta["tag"] = tag
             meta["version"] = "%s-%s" % (gitmeta["branch"], tag)
         else:
+            if epoch is None:
+                date = datetime.datetime.now()
+            else:
+                date = datetime.datetime.utcfromtimestamp(epoch)
             meta["version"] = "%s-%s" % (
                 gitmeta["branch"],
-                datetime.datetime.now().strftime("%Y%m%dT%H%M%S"),
+                date.strftime("%Y%m%dT%H%M%S"),
             )
          
         config = self.read_git_config(os.path.join(git_path, "config"))
@@ -345,7 +1582,9 @@ class Olut(object):
             gitmeta["url"] = url
             meta["name"] = url.rsplit('/', 1)[-1].rsplit('.', 1)[0]
         
-        meta["exclude_files"] = [x[chopped:] for x in self.get_git_ignored(path, ignoreunknown)]
+        if ignored:
+            # These are literal paths but exclude_files holds patterns
+            meta["exclude_files"] = [glob_escape(x[chopped:]) for x in self.get_git_ignored(path, ignoreunknown)]
 
         return meta
     
@@ -382,33 +1621,148 @@ class Olut(object):
         return config
     
     def get_package_info(self, path):
-        with closing(tarfile.open(path, "r:gz")) as fp:
-            meta = yaml.load(fp.extractfile(".olut/metadata.yaml"))
-        return meta
+        with open_tar_reader(path) as fp:
+            return self.read_package_meta(fp)
+
+    def get_package_manifest(self, path):
+        """Return the list of (pkgpath, size, mode, sha256, mtime) in a
+        package or None if it was built without a manifest"""
+        with open_tar_reader(path) as fp:
+            for member in fp:
+                if member.name == ".olut/manifest":
+                    return parse_manifest(fp.extractfile(member).read())
+                elif not member.name.startswith(".olut/"):
+                    # Manifest is always written at the start of the package
+                    return None
+
+    def read_package_meta(self, fp):
+        # Iterate rather than use getmember so this also works on streams.
+        # New packages have the metadata as the first member, older ones
+        # have it last which means reading the whole package.
+        for member in fp:
+            if member.name == ".olut/metadata.yaml":
+                return yaml.load(fp.extractfile(member))
+        raise Exception("Package is missing .olut/metadata.yaml")
 
     def get_installed_list(self):
         packages = dict((x, {})
             for x in os.listdir(self.install_path)
             if not x.startswith('.')
                and os.path.isdir(os.path.join(self.install_path, x)))
+        index = self.load_index()
+        changed = False
+        for name in list(index):
+            if name not in packages:
+                del index[name]
+                changed = True
         for name in packages:
-            packages[name]["versions"] = self.get_versions(name)
+            packages[name]["versions"], pkg_changed = self._get_versions(name, index)
             packages[name]["current"] = self.get_current_version(name)
+            changed = changed or pkg_changed
+        if changed:
+            self.refresh_index(index)
         return packages
     
     def get_versions(self, pkg):
-        versions = []
+        index = self.load_index()
+        versions, changed = self._get_versions(pkg, index)
+        if changed:
+            self.refresh_index(index)
+        return versions
+
+    def _get_versions(self, pkg, index):
+        """Return the sorted versions of pkg and whether the index entry
+        for it had to be updated. Metadata is only parsed for versions
+        that are missing from the index or whose metadata.yaml changed."""
+        indexed = index.get(pkg, {})
+        entries = {}
+        changed = False
         for ver in os.listdir(os.path.join(self.install_path, pkg)):
             ver_path = os.path.join(self.install_path, pkg, ver)
-            if (ver.startswith('.')
-                    or os.path.islink(ver_path)
-                    or not os.path.exists(os.path.join(ver_path, ".olut"))):
+            if ver.startswith('.') or os.path.islink(ver_path):
                 continue
-            with open(os.path.join(ver_path, ".olut", "metadata.yaml"), "r") as fp:
-                meta = yaml.load(fp)
-            versions.append((ver, meta))
+            meta_path = os.path.join(ver_path, ".olut", "metadata.yaml")
+            try:
+                mtime = os.stat(meta_path).st_mtime
+            except OSError:
+                continue
+            entry = indexed.get(ver)
+            if not entry or entry["mtime"] != mtime:
+                with open(meta_path, "r") as fp:
+                    entry = dict(mtime=mtime, meta=yaml.load(fp))
+                changed = True
+            entries[ver] = entry
+        if changed or len(entries) != len(indexed):
+            index[pkg] = entries
+            changed = True
+        versions = [(ver, entry["meta"]) for ver, entry in entries.iteritems()]
         versions.sort(key=lambda x:x[1]["install_date"], reverse=True)
-        return versions
+        return versions, changed
+
+    def load_index(self):
+        """Load the installed package index which maps package name to
+        {version: {"mtime": metadata.yaml mtime, "meta": metadata}}.
+        With cache_index set the parsed index is kept in memory until the
+        file is replaced."""
+        index_path = os.path.join(self.install_path, self.INDEX_FILENAME)
+        if self.cache_index:
+            try:
+                st = os.stat(index_path)
+            except OSError:
+                return {}
+            key = (st.st_ino, st.st_size, st.st_mtime)
+            if self._index_cache and self._index_cache[0] == key:
+                return self._index_cache[1]
+        try:
+            with open(index_path, "rb") as fp:
+                index = json.load(fp, object_hook=_json_object_hook)
+        except (IOError, ValueError):
+            return {}
+        if self.cache_index:
+            self._index_cache = (key, index)
+        return index
+
+    def save_index(self, index):
+        # Write to a temporary file and rename it over the index so readers
+        # never see a partial file. Concurrent writers can lose an update
+        # but the index is validated against the tree on every read.
+        fd, tmp_path = tempfile.mkstemp(prefix=self.INDEX_FILENAME, dir=self.install_path)
+        with os.fdopen(fd, "wb") as fp:
+            json.dump(index, fp, separators=(",", ":"), default=_json_default)
+        os.chmod(tmp_path, 0644)
+        if self.cache_index:
+            st = os.stat(tmp_path)
+            self._index_cache = ((st.st_ino, st.st_size, st.st_mtime), index)
+        os.rename(tmp_path, os.path.join(self.install_path, self.INDEX_FILENAME))
+
+    def refresh_index(self, index):
+        """Save an index brought up to date on a read path. Reading only
+        needs read access to install_path so failing to write is fine,
+        the index is rebuilt from the tree again next time."""
+        try:
+            with self.lock(self.INDEX_FILENAME):
+                self.save_index(index)
+        except (IOError, OSError), e:
+            self.log.debug("Not updating the index: %s", e)
+
+    def update_index(self, pkg, ver=None, meta=None):
+        """Record an installed (or when meta is None an uninstalled)
+        version in the index. Packages whose directory is gone are
+        dropped from the index."""
+        with self.lock(self.INDEX_FILENAME):
+            self._update_index(pkg, ver, meta)
+
+    def _update_index(self, pkg, ver, meta):
+        index = self.load_index()
+        entries = index.setdefault(pkg, {})
+        if meta is None:
+            entries.pop(ver, None)
+            if not os.path.exists(os.path.join(self.install_path, pkg)):
+                del index[pkg]
+        else:
+            meta_path = os.path.join(self.install_path, pkg, ver, ".olut", "metadata.yaml")
+            entries[ver] = dict(mtime=os.stat(meta_path).st_mtime, meta=meta)
+        self.save_index(index)
 
     def get_current_version(self, pkg):
         cur = os.path.realpath(
@@ -416,21 +1770,269 @@ class Olut(object):
         return cur if cur != "current" else None
 
 
-def render_template(source, dest=None, pkg_ver_path=None, metaoverride=None):
+def makedirs(path):
+    """os.makedirs that doesn't fail if another process created the
+    directory first"""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def syncfs(path):
+    """syncfs(2) the filesystem holding path. Returns False if the
+    platform doesn't have it."""
+    try:
+        func = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if func(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+    finally:
+        os.close(fd)
+    return True
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sort_dependencies(metas):
+    """Sort package metadata so packages come after the packages in
+    their depends list. Dependencies outside of metas are ignored."""
+    by_name = dict((meta["name"], meta) for meta in metas)
+    ordered = []
+    state = {}
+    def visit(name, path):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise Exception("Circular dependency: %s" % " -> ".join(path + [name]))
+        state[name] = "visiting"
+        for dep in by_name[name].get("depends") or []:
+            if dep in by_name:
+                visit(dep, path + [name])
+        state[name] = "done"
+        ordered.append(by_name[name])
+    for meta in metas:
+        visit(meta["name"], [])
+    return ordered
+
+
+def glob_escape(path):
+    """Quote the glob characters in path so it only matches itself"""
+    return re.sub(r"([*?[])", r"[\1]", path)
+
+
+class PathMatcher(object):
+    """Match package paths against a list of exact paths and glob
+    patterns (a trailing / is ignored). Exact paths are kept in a set and
+    globs are compiled into a single regular expression."""
+
+    def __init__(self, patterns):
+        self.patterns = [x for x in patterns if x]
+        self.exact = set()
+        globs = []
+        for pattern in self.patterns:
+            pattern = pattern.rstrip('/')
+            if re.search(r"[*?[]", pattern):
+                globs.append("(?:%s)" % fnmatch.translate(pattern))
+            else:
+                self.exact.add(pattern)
+        self.regex = re.compile("|".join(globs)) if globs else None
+
+    def match(self, path):
+        return path in self.exact or bool(self.regex and self.regex.match(path))
+
+    def match_dir(self, path):
+        """Match a directory by its path or, for compatibility with
+        exclude lists of bare names, its name"""
+        return self.match(path) or self.match(path.rsplit('/', 1)[-1])
+
+    def match_tree(self, path, names=True):
+        """Match a file by its path or the path of any parent directory.
+        Parent directories also match by name (see match_dir) unless names
+        is False."""
+        if self.match(path):
+            return True
+        match_dir = self.match_dir if names else self.match
+        while "/" in path:
+            path = path.rsplit('/', 1)[0]
+            if match_dir(path):
+                return True
+        return False
+
+
+def match_versions(versions, ver_spec, current_version=None):
+    """Return the versions matching ver_spec from a list of (version,
+    meta) sorted newest first. See Version Matching in the README."""
+    if ver_spec == "*":
+        return [x[0] for x in versions]
+    elif ver_spec[0] == '@':
+        if not current_version:
+            raise Exception("Trying to find version '%s' when no version is current" % ver_spec)
+        
+        ver_spec = ver_spec[1:]
+        if len(ver_spec) == 1 or ver_spec[1] in ('-', '+'): # --- / +++
+            offset = -int(ver_spec[0]+(ver_spec[1:] or '1'))
+        else: # -2 / +5
+            offset = -int(ver_spec)
+        
+        names = [x[0] for x in versions]
+        if current_version not in names:
+            raise Exception("Current version %s isn't one of the versions to match against" % current_version)
+        current_i = names.index(current_version)
+        return [versions[max(0, current_i+offset)][0]]
+    elif ":" in ver_spec:
+        start, end = ver_spec.split(':')
+        start = int(start) if start else 0
+        end = int(end) if end else len(versions)
+        return [x[0] for x in versions[start:end]]
+
+    try:
+        ver_i = int(ver_spec)
+    except ValueError:
+        pass
+    else:
+        return [versions[ver_i][0]]
+
+    return []
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return {"$datetime": obj.strftime("%Y-%m-%dT%H:%M:%S.%f")}
+    elif isinstance(obj, datetime.date):
+        return {"$date": obj.strftime("%Y-%m-%d")}
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1:
+        if "$datetime" in obj:
+            return datetime.datetime.strptime(obj["$datetime"], "%Y-%m-%dT%H:%M:%S.%f")
+        elif "$date" in obj:
+            return datetime.datetime.strptime(obj["$date"], "%Y-%m-%d").date()
+    return obj
+
+
+def format_manifest(manifest):
+    """Format (pkgpath, size, mode, sha256, mtime) rows as manifest lines
+    of 'mode size mtime sha256 path' with - for a missing sha256"""
+    return "".join(
+        "%o %d %d %s %s\n" % (mode, size, mtime, digest or "-", pkgpath)
+        for pkgpath, size, mode, digest, mtime in manifest)
+
+
+def normalize_perm(mode):
+    """Permissions a reproducible build records for a file: 0777 for
+    symlinks, 0755 for anything executable and 0644 for the rest"""
+    if stat.S_ISLNK(mode):
+        return 0777
+    return 0755 if mode & 0111 else 0644
+
+
+def reproducible_filter(epoch):
+    """Return a tarfile add filter that normalizes owners, permissions
+    and mtimes the same way as the manifest of a reproducible build"""
+    def normalize(ti):
+        ti.uid = ti.gid = 0
+        ti.uname = ti.gname = ""
+        ti.mtime = epoch
+        ti.mode = normalize_perm(ti.mode | (stat.S_IFLNK if ti.issym() else stat.S_IFREG))
+        return ti
+    return normalize
+
+
+def parse_manifest(text):
+    manifest = []
+    for line in text.splitlines():
+        mode, size, mtime, digest, pkgpath = line.split(" ", 4)
+        manifest.append((pkgpath, int(size), int(mode, 8), digest if digest != "-" else None, int(mtime)))
+    return manifest
+
+
+def file_digest(fp):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fp.read(1024*1024), ""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def path_digest(path):
+    """sha256 of a file's contents or a symlink's target"""
+    if os.path.islink(path):
+        return hashlib.sha256(os.readlink(path)).hexdigest()
+    # Unbuffered so reads go straight through in 1MB chunks. hashlib
+    # releases the GIL while hashing them so this scales across threads.
+    with open(path, "rb", 0) as fp:
+        return file_digest(fp)
+
+
+def _get_pkg_ver_path(pkg_ver_path):
     pkg_ver_path = pkg_ver_path or os.getenv("PKG_VERSION_PATH")
     if not pkg_ver_path or not os.path.exists(pkg_ver_path):
         sys.stderr.write("Must either pass in package version path or PKG_VERSION_PATH environment should be set\n")
         sys.exit(1)
-    if not source.startswith('/'):
-        source = os.path.join(pkg_ver_path, source)
+    return pkg_ver_path
+
+
+def get_template_context(pkg_ver_path, metaoverride=None, environ=None):
     with open(os.path.join(pkg_ver_path, ".olut", "metadata.yaml"), "r") as fp:
         meta = yaml.load(fp)
     if metaoverride:
         meta.update(metaoverride)
     meta.update(
         version_path = pkg_ver_path,
-        env = os.environ,
+        env = os.environ if environ is None else environ,
     )
+    return meta
+
+
+def render_file(source, dest, context, digest=None):
+    """Render source to dest atomically. If digest is given it's the
+    digest of the last render of dest and nothing is written if the
+    template and the context values it uses haven't changed. Returns the
+    digest of this render."""
+    with open(source, "rb") as fp:
+        template = fp.read()
+    # Only hash the context values the template refers to, the
+    # environment as a whole changes too often to be useful
+    formatter = string.Formatter()
+    values = []
+    for literal, field, spec, conversion in formatter.parse(template):
+        if field is not None:
+            values.append((field, repr(formatter.get_field(field, (), context)[0])))
+    new_digest = hashlib.sha256(template + "\0" + repr(sorted(values))).hexdigest()
+    if digest == new_digest and os.path.exists(dest):
+        return new_digest
+
+    text = template.format(**context)
+    fd, tmp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(dest), dir=os.path.dirname(dest))
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(text)
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(source).st_mode))
+        os.rename(tmp_path, dest)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return new_digest
+
+
+def render_template(source, dest=None, pkg_ver_path=None, metaoverride=None, environ=None):
+    pkg_ver_path = _get_pkg_ver_path(pkg_ver_path)
+    if not source.startswith('/'):
+        source = os.path.join(pkg_ver_path, source)
+    meta = get_template_context(pkg_ver_path, metaoverride, environ)
 
     if not dest:
         if not source.endswith('.tmpl'):
@@ -439,25 +2041,118 @@ def render_template(source, dest=None, pkg_ver_path=None, metaoverride=None):
         dest = source.rsplit('.', 1)[0]
     if not dest.startswith('/'):
         dest = os.path.join(pkg_ver_path, dest)
-    with open(source, "rb") as fp:
-        text = fp.read().format(**meta)
-    with open(dest, "wb") as fp:
-        fp.write(text)
+    render_file(source, dest, meta)
+
+
+RENDER_CACHE_PATH = os.path.join(".olut", "render.json")
+
+def render_all(pkg_ver_path=None, metaoverride=None, jobs=None, environ=None):
+    """Render every *.tmpl file under the version path in parallel with
+    the metadata loaded once. Templates whose output is up to date (by a
+    digest of the template and the context values it uses) are
+    skipped. Returns the number of files rendered."""
+    pkg_ver_path = _get_pkg_ver_path(pkg_ver_path)
+    meta = get_template_context(pkg_ver_path, metaoverride, environ)
+    sources = []
+    for root, dirs, files in os.walk(pkg_ver_path):
+        if root == pkg_ver_path and ".olut" in dirs:
+            dirs.remove(".olut")
+        sources.extend(os.path.join(root, f) for f in files if f.endswith(".tmpl"))
+
+    cache_path = os.path.join(pkg_ver_path, RENDER_CACHE_PATH)
+    try:
+        with open(cache_path, "rb") as fp:
+            digests = json.load(fp)
+    except (IOError, ValueError):
+        digests = {}
+
+    def render(source):
+        dest = source.rsplit('.', 1)[0]
+        relpath = dest[len(pkg_ver_path)+1:]
+        return relpath, render_file(source, dest, meta, digests.get(relpath))
+    pool = ThreadPool(jobs or multiprocessing.cpu_count() * 2)
+    try:
+        results = pool.map(render, sources)
+    finally:
+        pool.close()
+        pool.join()
+
+    rendered = sum(1 for relpath, digest in results if digests.get(relpath) != digest)
+    new_digests = dict(results)
+    if new_digests != digests:
+        fd, tmp_path = tempfile.mkstemp(prefix=".render", dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, "wb") as fp:
+            json.dump(new_digests, fp)
+        os.rename(tmp_path, cache_path)
+    logging.getLogger("olut").info("Rendered %d of %d templates", rendered, len(sources))
+    return rendered
 
 
 def build_parser():
     parser = OptionParser(usage="Usage: %prog [options] <command> [arg1] [arg2]")
     parser.add_option("-a", "--activate", dest="activate", help="Activate version on install (off by default)", default=False, action="store_true")
+    parser.add_option("-b", "--base", dest="base", help="Build a delta package against a base package or installed .olut/manifest")
+    parser.add_option("-A", "--all", dest="render_all", help="Render every *.tmpl file in the version path", default=False, action="store_true")
+    parser.add_option("-C", "--cache", dest="cache", help="Cache file hashes in <destination_path>/.olut-cache and skip unchanged builds", default=False, action="store_true")
+    parser.add_option("-c", "--compression", dest="compression", help="Compression for built packages: gzip, pigz, zstd, xz or none (default gzip)")
+    parser.add_option("-D", "--durable", dest="durable", help="Flush installed files to disk (one syncfs or a batch of fsyncs) before renaming them into place", default=False, action="store_true")
+    parser.add_option("-d", "--dedup", dest="dedup", help="Hardlink installed files from a shared content addressed store", default=False, action="store_true")
+    parser.add_option("-G", "--git-files", dest="gitfiles", help="Build from the files tracked by git plus include_files instead of walking the source path", default=False, action="store_true")
+    parser.add_option("-f", "--fast", dest="fast", help="Only hash files whose size or mtime changed when verifying", default=False, action="store_true")
     parser.add_option("-g", "--gitdepth", dest="gitdepth", type="int", help="Number of directories upwards to check for .git", default=1)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help="Number of packages to install in parallel when installing several")
+    parser.add_option("-k", "--keep", dest="keep_versions", type="int", help="After install uninstall all but this many of the newest versions")
+    parser.add_option("-K", "--keep-days", dest="keep_days", type="float", help="After install uninstall versions installed more than this many days ago (with --keep both must apply)")
+    parser.add_option("-l", "--level", dest="level", type="int", help="Compression level for built packages")
     parser.add_option("-m", "--meta", dest="meta", help="Additional meta data (name=value)", action="append")
+    parser.add_option("-N", "--no-agent", dest="no_agent", help="Run the command in process even if an agent is listening", default=False, action="store_true")
     parser.add_option("-p", "--path", dest="path", help="Install path")
+    parser.add_option("-R", "--reproducible", dest="reproducible", help="Build a byte for byte reproducible package (timestamps from SOURCE_DATE_EPOCH)", default=False, action="store_true")
+    parser.add_option("-r", "--repository", dest="repository", help="Package repository (a directory or http URL) to install name[@version] from")
     parser.add_option("-q", "--quiet", dest="quiet", help="Quiet output", default=False, action="store_true")
     parser.add_option("-s", "--ssh", dest="ssh_agent_forward", help="Enable SSH agent forwarding (pass environment variables to scripts)", default=False, action="store_true")
+    parser.add_option("-t", "--timeout", dest="script_timeout", type="float", help="Kill package scripts that run longer than this many seconds")
+    parser.add_option("-L", "--script-log-limit", dest="script_log_limit", type="int", help="Stop logging a package script's output after this many bytes")
+    parser.add_option("-T", "--timings", dest="timings", help="Write JSON timing events to a file (- for stderr)")
+    parser.add_option("-P", "--profile", dest="profile", help="Run the command under cProfile and dump the stats to a file")
     parser.add_option("-v", "--verbose", dest="verbose", help="Verbose output", default=False, action="store_true")
     parser.add_option("-V", "--version", dest="version", help="Show version and exit", default=False, action="store_true")
     return parser
 
 
+def run_in_agent(olut, command, args, kwargs):
+    """Send the command to the agent listening under the install path and
+    exit with its status. Returns if there's no agent to run it."""
+    from olut.agent import AGENT_COMMANDS, AgentError, call, get_socket_path
+    if command not in AGENT_COMMANDS:
+        return
+    kwargs = dict(kwargs)
+    if command in ("activate", "deactivate", "render", "render_all"):
+        # Scripts and templates see the caller's environment, not the
+        # agent's
+        kwargs["environ"] = dict(os.environ)
+    if command in ("render", "render_all"):
+        pkg_ver_path = os.getenv("PKG_VERSION_PATH")
+        if pkg_ver_path:
+            kwargs["pkg_ver_path"] = os.path.abspath(pkg_ver_path)
+    elif command == "info":
+        args = [os.path.abspath(x) for x in args]
+    try:
+        response = call(get_socket_path(olut.install_path), command, args, kwargs)
+    except socket.error, e:
+        olut.log.debug("Agent not available (%s), running in process", e)
+        return
+    except AgentError, e:
+        # The agent may have run some or all of the command so it's not
+        # safe to run it again in process
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    sys.stdout.write(response["output"])
+    if response["error"]:
+        sys.stderr.write(response["error"] + "\n")
+    sys.exit(response["status"])
+
+
 def main():
     parser = build_parser()
     options, args = parser.parse_args()
@@ -471,6 +2166,8 @@ def main():
         command = args.pop(0)
     except IndexError:
         parser.error("must specify a command")
+    if options.keep_versions is not None and options.keep_versions < 1:
+        parser.error("--keep must be at least 1")
 
     if options.verbose:
         logging.basicConfig(level=logging.DEBUG)
@@ -482,7 +2179,21 @@ def main():
         install_path = options.path,
         gitdepth = options.gitdepth,
         ssh_agent_forward = options.ssh_agent_forward,
+        dedup = options.dedup,
+        script_timeout = options.script_timeout,
+        script_log_limit = options.script_log_limit,
+        timings = options.timings,
+        keep_versions = options.keep_versions,
+        keep_days = options.keep_days,
+        background_gc = True,
+        cache_index = command == "agent",
+        repository = options.repository,
+        durable = options.durable,
     )
+    if command == "agent":
+        from olut.agent import serve
+        serve(olut)
+        return
     kwargs = {}
     if options.meta:
         kwargs["metaoverride"] = dict(
@@ -490,10 +2201,49 @@ def main():
         )
     if options.activate:
         kwargs["activate"] = True
+    if options.base:
+        kwargs["base"] = options.base
+    if options.gitfiles:
+        kwargs["gitfiles"] = True
+    if options.cache:
+        kwargs["cache"] = True
+    if options.reproducible:
+        kwargs["reproducible"] = True
+    if options.compression:
+        kwargs["compression"] = options.compression
+    if options.level is not None:
+        kwargs["level"] = options.level
+    if command == "install" and len(args) > 1:
+        command = "install_many"
+        args = [args]
+    if command == "render" and options.render_all:
+        command = "render_all"
+    if options.jobs and command in ("install_many", "verify", "render_all", "gc"):
+        kwargs["jobs"] = options.jobs
+    if options.fast:
+        kwargs["fast"] = True
+    # The agent runs commands with its own settings so only use it when
+    # none of the options that change how they run were given
+    if not (options.no_agent or options.profile or options.timings or options.ssh_agent_forward
+            or options.script_timeout or options.script_log_limit):
+        run_in_agent(olut, command, args, kwargs)
     if command == "render":
-        render_template(*args, **kwargs)
-        sys.exit(0)
-    getattr(olut, command)(*args, **kwargs)
+        func = render_template
+    elif command == "render_all":
+        func = render_all
+    elif command == "index":
+        func = olut.index_repository
+    else:
+        func = getattr(olut, command)
+    if options.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(func, *args, **kwargs)
+        finally:
+            profile.dump_stats(options.profile)
+    else:
+        func(*args, **kwargs)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,215 @@
+import gzip
+import logging
+import multiprocessing
+import subprocess
+import tarfile
+import threading
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+
+log = logging.getLogger("olut")
+
+# name -> (file extension, external command, thread flag)
+COMPRESSION_TYPES = {
+    "gzip": ("tgz", None, None),
+    "pigz": ("tgz", "pigz", "-p%d"),
+    "zstd": ("tar.zst", "zstd", "-T%d"),
+    "xz": ("tar.xz", "xz", "-T%d"),
+    "none": ("tar", None, None),
+}
+DEFAULT_COMPRESSION = "gzip"
+
+MAGIC = (
+    ("\x1f\x8b", "gzip"),
+    ("\x28\xb5\x2f\xfd", "zstd"),
+    ("\xfd7zXZ\x00", "xz"),
+)
+
+def check_compression(compression):
+    if compression not in COMPRESSION_TYPES:
+        raise Exception("Unknown compression type %s (must be one of %s)" % (
+            compression, ", ".join(sorted(COMPRESSION_TYPES))))
+
+def get_extension(compression):
+    check_compression(compression)
+    return COMPRESSION_TYPES[compression][0]
+
+def detect_compression(path):
+    with open(path, "rb") as fp:
+        return _detect(fp.read(6))
+
+def _detect(head):
+    for magic, compression in MAGIC:
+        if head.startswith(magic):
+            return compression
+    return "none"
+
+
+class PrefixedReader(object):
+    """File-like object that returns prefix before the rest of fileobj.
+    Used to put back bytes read from a stream to detect compression."""
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), ""
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.fileobj.read(size - len(data))
+        return data
+
+@contextmanager
+def open_tar_writer(path, compression=DEFAULT_COMPRESSION, level=None, threads=None, reproducible=False):
+    """Open a tarfile for writing a package. With reproducible set the
+    compressed output depends only on the archive's contents: gzip headers
+    have no filename or mtime and xz runs single threaded as its block
+    layout depends on the thread count."""
+    check_compression(compression)
+    ext, cmd, thread_flag = COMPRESSION_TYPES[compression]
+    if cmd and not find_executable(cmd):
+        if compression != "pigz":
+            raise Exception("%s compression requires the %s command" % (compression, cmd))
+        log.warning("pigz not found, falling back to single threaded gzip")
+        compression, cmd = "gzip", None
+    if not cmd:
+        closers = []
+        if compression == "gzip" and reproducible:
+            outfp = open(path, "wb")
+            closers.append(outfp)
+            gzfp = gzip.GzipFile(filename="", mode="wb", fileobj=outfp, mtime=0,
+                compresslevel=9 if level is None else level)
+            closers.append(gzfp)
+            fp = tarfile.open(fileobj=gzfp, mode="w")
+        elif compression == "gzip":
+            fp = tarfile.open(path, "w:gz", compresslevel=9 if level is None else level)
+        else:
+            fp = tarfile.open(path, "w")
+        try:
+            yield fp
+        finally:
+            fp.close()
+            for closer in reversed(closers):
+                closer.close()
+        return
+
+    if reproducible and compression == "xz":
+        threads = 1
+    args = [cmd, "-q", "-c", thread_flag % (threads or multiprocessing.cpu_count())]
+    if reproducible and compression == "pigz":
+        args.append("-n")
+    if level is not None:
+        args.append("-%d" % level)
+    with open(path, "wb") as outfp:
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=outfp)
+        try:
+            fp = tarfile.open(fileobj=proc.stdin, mode="w|")
+            try:
+                yield fp
+            finally:
+                fp.close()
+        finally:
+            proc.stdin.close()
+            proc.wait()
+    if proc.returncode != 0:
+        raise Exception("%s returned a non-zero return code %d" % (cmd, proc.returncode))
+
+@contextmanager
+def open_tar_reader(path):
+    """Open a package for reading, detecting its compression. gzip and
+    uncompressed packages support random access, the rest are streams
+    (mode r|) so members must be read in archive order."""
+    compression = detect_compression(path)
+    ext, cmd, thread_flag = COMPRESSION_TYPES[compression]
+    if not cmd:
+        fp = tarfile.open(path, "r")
+        try:
+            yield fp
+        finally:
+            fp.close()
+        return
+
+    if not find_executable(cmd):
+        raise Exception("%s is required to read %s" % (cmd, path))
+    proc = subprocess.Popen([cmd, "-q", "-d", "-c", path], stdout=subprocess.PIPE)
+    complete = False
+    try:
+        fp = tarfile.open(fileobj=proc.stdout, mode="r|")
+        try:
+            yield fp
+            complete = read_to_end(fp, proc)
+        finally:
+            fp.close()
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if complete and proc.returncode != 0:
+        raise Exception("%s returned a non-zero return code %d reading %s (truncated package?)" % (
+            cmd, proc.returncode, path))
+
+def read_to_end(fp, proc):
+    """Return whether every member of the tarfile fp, read from the
+    stdout of the decompressor proc, was read. If so the rest of the
+    output (the padding after the end of the archive) is drained so the
+    decompressor can exit normally and its return code tells whether the
+    input was complete. Readers that stopped early kill it instead and
+    its return code means nothing."""
+    # A truncated stream can end exactly on a header boundary which
+    # tarfile takes for the end of the archive
+    if not fp._loaded:
+        return False
+    for chunk in iter(lambda: proc.stdout.read(65536), ""):
+        pass
+    return True
+
+@contextmanager
+def open_tar_stream(fileobj):
+    """Open a package from a non-seekable file object such as stdin or a
+    socket. Members must be read in archive order."""
+    head = fileobj.read(6)
+    compression = _detect(head)
+    ext, cmd, thread_flag = COMPRESSION_TYPES[compression]
+    if not cmd:
+        fp = tarfile.open(fileobj=PrefixedReader(head, fileobj), mode="r|*")
+        try:
+            yield fp
+        finally:
+            fp.close()
+        return
+
+    if not find_executable(cmd):
+        raise Exception("%s is required to read %s packages" % (cmd, compression))
+    proc = subprocess.Popen([cmd, "-q", "-d", "-c"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    def feed():
+        try:
+            proc.stdin.write(head)
+            for chunk in iter(lambda: fileobj.read(1024*1024), ""):
+                proc.stdin.write(chunk)
+        except IOError:
+            # Decompressor exited early, the reader will see the error
+            pass
+        finally:
+            proc.stdin.close()
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    complete = False
+    try:
+        fp = tarfile.open(fileobj=proc.stdout, mode="r|")
+        try:
+            yield fp
+            complete = read_to_end(fp, proc)
+        finally:
+            fp.close()
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        feeder.join()
+    if complete and proc.returncode != 0:
+        raise Exception("%s returned a non-zero return code %d reading the package stream (truncated package?)" % (
+            cmd, proc.returncode))
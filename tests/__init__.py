@@ -37,3 +37,514 @@ class BasicTests(unittest.TestCase):
         self.testActivate()
         self.olut.deactivate("testapp")
         self.failUnless(not os.path.exists("%s/testapp/current" % TEMP_PATH))
+
+    def testInstallIgnoresInvalidNames(self):
+        import tarfile
+        from StringIO import StringIO
+        os.makedirs(TEMP_PATH)
+        pkgpath = "%s/evil-1.0.tgz" % TEMP_PATH
+        fp = tarfile.open(pkgpath, "w:gz")
+        for name, data in ((".olut/metadata.yaml", "name: evil\nversion: 1.0\n"), ("../evil.txt", "x"), ("ok.txt", "x")):
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            fp.addfile(ti, StringIO(data))
+        fp.close()
+        self.olut.install(pkgpath)
+        self.failUnless(os.path.exists("%s/evil/1.0/ok.txt" % TEMP_PATH))
+        self.failUnless(not os.path.exists("%s/evil/evil.txt" % TEMP_PATH))
+
+    def testCompression(self):
+        for compression, ext in (("none", "tar"), ("xz", "tar.xz"), ("zstd", "tar.zst")):
+            self.cleanTempPath()
+            pkgpath = self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH, compression=compression, level=1)
+            self.failUnlessEqual(pkgpath, "%s/testapp-1.0.%s" % (TEMP_PATH, ext))
+            self.failUnlessEqual(self.olut.get_package_info(pkgpath)["name"], "testapp")
+            self.olut.install(pkgpath)
+            self.failUnless(os.path.exists("%s/testapp/1.0/code.py" % TEMP_PATH))
+        try:
+            self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH, compression="bogus")
+        except Exception, e:
+            self.failUnless("Unknown compression type bogus" in str(e))
+        else:
+            self.fail("Unknown compression type accepted")
+
+    def testMetadataFirst(self):
+        import tarfile
+        pkgpath = self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH)
+        fp = tarfile.open(pkgpath, "r")
+        self.failUnlessEqual(fp.next().name, ".olut/metadata.yaml")
+        fp.close()
+        manifest = self.olut.get_package_manifest(pkgpath)
+        self.failUnless("code.py" in [x[0] for x in manifest])
+
+    def testIndex(self):
+        self.testInstall()
+        index = self.olut.load_index()
+        self.failUnlessEqual(index["testapp"]["1.0"]["meta"]["name"], "testapp")
+        # A stale index is rebuilt from the tree
+        os.unlink(os.path.join(TEMP_PATH, Olut.INDEX_FILENAME))
+        self.failUnlessEqual([x[0] for x in self.olut.get_versions("testapp")], ["1.0"])
+        self.failUnless("testapp" in self.olut.load_index())
+        # Reading works without write access to the install path
+        os.unlink(os.path.join(TEMP_PATH, Olut.INDEX_FILENAME))
+        def save_index(index):
+            raise OSError(13, "Permission denied")
+        self.olut.save_index = save_index
+        self.failUnlessEqual([x[0] for x in self.olut.get_installed_list()["testapp"]["versions"]], ["1.0"])
+        del self.olut.save_index
+        self.olut.uninstall("testapp", "1.0")
+        self.failUnless("testapp" not in self.olut.load_index())
+
+    def testDedup(self):
+        self.olut = Olut(TEMP_PATH, dedup=True)
+        pkgpath = self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH)
+        self.olut.install(pkgpath)
+        self.olut.install(pkgpath, metaoverride={"version": "1.1"})
+        st1 = os.stat("%s/testapp/1.0/code.py" % TEMP_PATH)
+        st2 = os.stat("%s/testapp/1.1/code.py" % TEMP_PATH)
+        self.failUnlessEqual(st1.st_ino, st2.st_ino)
+        self.olut.uninstall("testapp", "*")
+        objects = [f for r, d, fs in os.walk(os.path.join(TEMP_PATH, Olut.OBJECTS_DIRNAME)) for f in fs]
+        self.failUnlessEqual(objects, [])
+
+    def testDelta(self):
+        import shutil
+        srcpath = os.path.join(TEMP_PATH, "src", "testapp")
+        shutil.copytree(os.path.join(TEST_PATH, "testapp"), srcpath)
+        with open(os.path.join(srcpath, "static.txt"), "w") as fp:
+            fp.write("static")
+        basepath = self.olut.build(srcpath, TEMP_PATH)
+        with open(os.path.join(srcpath, "code.py"), "w") as fp:
+            fp.write("changed")
+        os.unlink(os.path.join(srcpath, "static.txt"))
+        with open(os.path.join(srcpath, "new.txt"), "w") as fp:
+            fp.write("new")
+        deltapath = self.olut.build(srcpath, TEMP_PATH, metaoverride={"version": "1.1"}, base=basepath)
+        self.failUnlessEqual(deltapath, "%s/testapp-1.1.delta.tgz" % TEMP_PATH)
+        self.failUnlessRaises(Exception, self.olut.install, deltapath)
+        self.olut.install(basepath)
+        self.olut.install(deltapath)
+        ver_path = "%s/testapp/1.1" % TEMP_PATH
+        self.failUnlessEqual(open(os.path.join(ver_path, "code.py")).read(), "changed")
+        self.failUnless(os.path.exists(os.path.join(ver_path, "new.txt")))
+        self.failUnless(not os.path.exists(os.path.join(ver_path, "static.txt")))
+        self.failUnlessEqual(
+            os.stat(os.path.join(ver_path, "olut/metadata.yaml")).st_ino,
+            os.stat("%s/testapp/1.0/olut/metadata.yaml" % TEMP_PATH).st_ino)
+        # A base that was changed after it was installed isn't linked
+        self.olut.uninstall("testapp", "1.1")
+        base_meta = "%s/testapp/1.0/olut/metadata.yaml" % TEMP_PATH
+        size = os.path.getsize(base_meta)
+        with open(base_meta, "w") as fp:
+            fp.write("#" * size)
+        self.failUnlessRaises(Exception, self.olut.install, deltapath)
+        self.failIf(os.path.exists(ver_path))
+
+    def testBuildCache(self):
+        pkgpath = self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH, cache=True)
+        build_date = self.olut.get_package_info(pkgpath)["build_date"]
+        self.failUnlessEqual(self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH, cache=True), pkgpath)
+        self.failUnlessEqual(self.olut.get_package_info(pkgpath)["build_date"], build_date)
+        self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH, cache=True, metaoverride={"extra": "1"})
+        self.failIfEqual(self.olut.get_package_info(pkgpath)["build_date"], build_date)
+
+    def testGitFiles(self):
+        import shutil
+        srcpath = os.path.join(TEMP_PATH, "src")
+        shutil.copytree(os.path.join(TEST_PATH, "testapp"), srcpath)
+        os.makedirs(os.path.join(srcpath, "build", "sub"))
+        for name in ("build/out.bin", "build/sub/keep.css", "untracked.txt"):
+            with open(os.path.join(srcpath, name), "w") as fp:
+                fp.write(name)
+        with open(os.path.join(srcpath, ".gitignore"), "w") as fp:
+            fp.write("build/\n")
+        subprocess.check_call(
+            "cd %s && git init -q && git add code.py olut .gitignore"
+            " && git -c user.name=test -c user.email=test@example.com commit -qm init" % srcpath,
+            shell=True)
+        self.olut.build(srcpath, TEMP_PATH, gitfiles=True, metaoverride={"include_files": ["build/*/*.css"]})
+        names = [x[0] for x in self.olut.get_package_manifest("%s/testapp-1.0.tgz" % TEMP_PATH)]
+        self.failUnless("code.py" in names)
+        self.failUnless("build/sub/keep.css" in names)
+        self.failUnless("build/out.bin" not in names)
+        self.failUnless("untracked.txt" not in names)
+
+    def testGitIgnoredGlobCharacters(self):
+        import shutil
+        srcpath = os.path.join(TEMP_PATH, "src")
+        shutil.copytree(os.path.join(TEST_PATH, "testapp"), srcpath)
+        for name in ("secret1.txt", "secret[1].txt"):
+            with open(os.path.join(srcpath, name), "w") as fp:
+                fp.write(name)
+        with open(os.path.join(srcpath, ".gitignore"), "w") as fp:
+            fp.write("secret?1?.txt\n")
+        subprocess.check_call(
+            "cd %s && git init -q && git add code.py olut .gitignore secret1.txt"
+            " && git -c user.name=test -c user.email=test@example.com commit -qm init" % srcpath,
+            shell=True)
+        pkgpath = self.olut.build(srcpath, TEMP_PATH)
+        names = [x[0] for x in self.olut.get_package_manifest(pkgpath)]
+        self.failUnless("secret1.txt" in names)
+        self.failUnless("secret[1].txt" not in names)
+
+    def testPathMatcher(self):
+        from olut.command import PathMatcher
+        matcher = PathMatcher(["build/", "*.log", "docs/api"])
+        self.failUnless(matcher.match_dir("build"))
+        self.failUnless(matcher.match_dir("src/build"))
+        self.failUnless(matcher.match("logs/server.log"))
+        self.failUnless(matcher.match_tree("docs/api/index.html"))
+        self.failIf(matcher.match_tree("docs/guide.html"))
+
+    def testInstallStream(self):
+        for compression in ("gzip", "zstd"):
+            self.cleanTempPath()
+            pkgpath = self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH, compression=compression)
+            with open(pkgpath, "rb") as fp:
+                self.olut.install(fp)
+            self.failUnless(os.path.exists("%s/testapp/1.0/code.py" % TEMP_PATH))
+            self.failUnlessEqual([x[0] for x in self.olut.get_versions("testapp")], ["1.0"])
+            self.failUnlessEqual([x for x in os.listdir(TEMP_PATH) if x.startswith(".staging")], [])
+
+    def testActivateSwitch(self):
+        os.environ.setdefault("USER", "olut")
+        pkgpath = self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH)
+        self.olut.install(pkgpath, activate=True)
+        self.olut.install(pkgpath, metaoverride={"version": "1.1"})
+        script_path = "%s/testapp/1.1/.olut/activate" % TEMP_PATH
+        with open(script_path, "w") as fp:
+            fp.write("#!/bin/sh\nexit 1\n")
+        os.chmod(script_path, 0755)
+        self.failUnlessRaises(Exception, self.olut.activate, "testapp", "1.1")
+        self.failUnlessEqual(self.olut.get_current_version("testapp"), "1.0")
+        os.unlink(script_path)
+        self.olut.activate("testapp", "1.1")
+        self.failUnlessEqual(self.olut.get_current_version("testapp"), "1.1")
+        self.failUnlessEqual(sorted(os.listdir("%s/testapp" % TEMP_PATH)), ["1.0", "1.1", "current"])
+
+    def testInstallMany(self):
+        pkgpaths = [
+            self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH, metaoverride={"name": name, "depends": depends})
+            for name, depends in (("app", ["lib"]), ("lib", []), ("other", []))]
+        self.olut.install_many(pkgpaths, activate=True)
+        for name in ("app", "lib", "other"):
+            self.failUnlessEqual(self.olut.get_current_version(name), "1.0")
+
+    def testSortDependencies(self):
+        from olut.command import sort_dependencies
+        metas = [dict(name="app", depends=["lib"]), dict(name="lib", depends=["base"]), dict(name="base")]
+        self.failUnlessEqual([x["name"] for x in sort_dependencies(metas)], ["base", "lib", "app"])
+        metas[2]["depends"] = ["app"]
+        self.failUnlessRaises(Exception, sort_dependencies, metas)
+
+    def testScriptTimeout(self):
+        import time
+        os.environ.setdefault("USER", "olut")
+        self.olut = Olut(TEMP_PATH, script_timeout=0.5)
+        self.testInstall()
+        os.makedirs("%s/testapp/1.0/.olut/activate.d" % TEMP_PATH)
+        for name, body in (("10-ok", "echo ok"), ("20-hang", "echo start; sleep 30")):
+            script_path = "%s/testapp/1.0/.olut/activate.d/%s" % (TEMP_PATH, name)
+            with open(script_path, "w") as fp:
+                fp.write("#!/bin/sh\n%s\n" % body)
+            os.chmod(script_path, 0755)
+        start = time.time()
+        self.failUnlessRaises(Exception, self.olut.runscript, "testapp", "1.0", "activate")
+        self.failUnless(time.time() - start < 10)
+        results = dict(self.olut.get_versions("testapp"))["1.0"]["script_results"]
+        self.failUnlessEqual(results["activate.d/10-ok"]["returncode"], 0)
+        self.failIfEqual(results["activate.d/20-hang"]["returncode"], 0)
+        # The metadata is replaced through a temporary file that is renamed away
+        self.failUnlessEqual(sorted(os.listdir("%s/testapp/1.0/.olut" % TEMP_PATH)),
+            ["activate.d", "manifest", "metadata.yaml"])
+
+    def testTimings(self):
+        import json
+        from StringIO import StringIO
+        timings = StringIO()
+        self.olut = Olut(TEMP_PATH, timings=timings)
+        self.testInstall()
+        events = [json.loads(x) for x in timings.getvalue().splitlines()]
+        names = [x["event"] for x in events]
+        for name in ("build.collect", "build.write", "build", "install.extract", "install"):
+            self.failUnless(name in names, name)
+        write = events[names.index("build.write")]
+        self.failUnless(write["files"] > 0 and write["bytes_out"] > 0)
+
+    def testVerify(self):
+        self.testActivate()
+        self.failUnlessEqual(self.olut.verify("testapp"), [])
+        self.failUnlessEqual(self.olut.verify("testapp", "1.0", fast=True), [])
+        with open("%s/testapp/1.0/olut/metadata.yaml" % TEMP_PATH, "r+") as fp:
+            data = fp.read()
+            fp.seek(0)
+            fp.write(data.upper())
+        self.failUnlessRaises(Exception, self.olut.verify, "testapp")
+        os.unlink("%s/testapp/1.0/code.py" % TEMP_PATH)
+        self.failUnlessRaises(Exception, self.olut.verify, "testapp", fast=True)
+
+    def testRenderAll(self):
+        from olut.command import render_all
+        self.testInstall()
+        ver_path = "%s/testapp/1.0" % TEMP_PATH
+        os.makedirs(os.path.join(ver_path, "conf"))
+        for name in ("a.conf.tmpl", "conf/b.conf.tmpl"):
+            with open(os.path.join(ver_path, name), "w") as fp:
+                fp.write("{name} {version_path}\n")
+        self.failUnlessEqual(render_all(ver_path), 2)
+        self.failUnlessEqual(open(os.path.join(ver_path, "conf/b.conf")).read(), "testapp %s\n" % ver_path)
+        self.failUnlessEqual(render_all(ver_path), 0)
+        self.failUnlessEqual(render_all(ver_path, metaoverride={"name": "other"}), 2)
+
+    def testRetention(self):
+        self.olut = Olut(TEMP_PATH, keep_versions=2)
+        pkgpath = self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH)
+        self.olut.install(pkgpath, activate=True)
+        for ver in ("1.1", "1.2", "1.3"):
+            self.olut.install(pkgpath, metaoverride={"version": ver})
+        self.failUnlessEqual(sorted(x[0] for x in self.olut.get_versions("testapp")), ["1.0", "1.2", "1.3"])
+        self.failUnlessEqual(os.listdir(os.path.join(TEMP_PATH, Olut.TRASH_DIRNAME)), [])
+        # The version being installed is never removed, even when it isn't
+        # one of the newest
+        self.olut = Olut(TEMP_PATH)
+        self.olut.install(pkgpath, metaoverride={"version": "0.9", "keep_versions": 0})
+        self.failUnlessEqual(sorted(x[0] for x in self.olut.get_versions("testapp")), ["0.9", "1.0"])
+        self.failUnlessRaises(ValueError, Olut, TEMP_PATH, keep_versions=0)
+
+    def testUninstallTrash(self):
+        self.olut = Olut(TEMP_PATH, background_gc=True)
+        self.testInstall()
+        self.olut.uninstall("testapp", "1.0")
+        self.failIf(os.path.exists("%s/testapp" % TEMP_PATH))
+        self.olut.gc()
+        self.failUnlessEqual(os.listdir(os.path.join(TEMP_PATH, Olut.TRASH_DIRNAME)), [])
+
+    def testAgent(self):
+        import socket
+        import threading
+        from olut.agent import AgentError, AgentServer, call
+        os.environ.setdefault("USER", "olut")
+        self.olut = Olut(TEMP_PATH, cache_index=True)
+        self.testInstall()
+        script_path = "%s/testapp/1.0/.olut/activate" % TEMP_PATH
+        with open(script_path, "w") as fp:
+            fp.write("#!/bin/sh\necho $USER > %s/activated-by\n" % TEMP_PATH)
+        os.chmod(script_path, 0755)
+        socket_path = os.path.join(TEMP_PATH, ".agent.sock")
+        server = AgentServer(self.olut, socket_path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            environ = dict(os.environ, USER="caller")
+            self.failUnlessEqual(call(socket_path, "activate", ["testapp", "1.0"], dict(environ=environ))["status"], 0)
+            self.failUnlessEqual(self.olut.get_current_version("testapp"), "1.0")
+            self.failUnlessEqual(open("%s/activated-by" % TEMP_PATH).read(), "caller\n")
+            response = call(socket_path, "list")
+            self.failUnless("@ 1.0" in response["output"])
+            self.failUnlessEqual(call(socket_path, "build")["status"], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        os.unlink(socket_path)
+        self.failUnlessRaises(socket.error, call, socket_path, "list")
+
+        # Losing the agent after connecting isn't the same as there being
+        # no agent, the command may have run
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(socket_path)
+        sock.listen(1)
+        def drop():
+            sock.accept()[0].close()
+        thread = threading.Thread(target=drop)
+        thread.start()
+        try:
+            self.failUnlessRaises(AgentError, call, socket_path, "activate", ["testapp", "1.0"])
+        finally:
+            thread.join()
+            sock.close()
+
+    def testLayers(self):
+        import shutil
+        srcpath = os.path.join(TEMP_PATH, "src", "testapp")
+        shutil.copytree(os.path.join(TEST_PATH, "testapp"), srcpath)
+        os.makedirs(os.path.join(srcpath, "venv", "lib"))
+        with open(os.path.join(srcpath, "venv", "lib", "dep.py"), "w") as fp:
+            fp.write("dep")
+        # Layer paths are anchored at the package root
+        os.makedirs(os.path.join(srcpath, "tests", "venv"))
+        with open(os.path.join(srcpath, "tests", "venv", "fixture.py"), "w") as fp:
+            fp.write("fixture")
+        layers = [dict(name="deps", paths=["venv/"])]
+        pkgpath = self.olut.build(srcpath, TEMP_PATH, metaoverride={"layers": layers})
+        meta = self.olut.get_package_info(pkgpath)
+        layer_path = os.path.join(TEMP_PATH, meta["layers"][0]["file"])
+        self.failUnless(os.path.exists(layer_path))
+        paths = [row[0] for row in self.olut.get_package_digests(pkgpath)]
+        self.failIf(any(x.startswith("venv/") for x in paths))
+        self.failUnless("tests/venv/fixture.py" in paths)
+        self.olut.install(pkgpath)
+
+        # Only the app changed so the layer is reused and doesn't have to
+        # be shipped again
+        with open(os.path.join(srcpath, "code.py"), "w") as fp:
+            fp.write("changed")
+        layers = [dict(name="deps", paths=["venv/"])]
+        pkgpath = self.olut.build(srcpath, TEMP_PATH, metaoverride={"version": "1.1", "layers": layers})
+        self.failUnlessEqual(self.olut.get_package_info(pkgpath)["layers"][0]["hash"], meta["layers"][0]["hash"])
+        os.unlink(layer_path)
+        self.olut.install(pkgpath)
+        self.failUnlessEqual(
+            os.stat("%s/testapp/1.0/venv/lib/dep.py" % TEMP_PATH).st_ino,
+            os.stat("%s/testapp/1.1/venv/lib/dep.py" % TEMP_PATH).st_ino)
+        self.failUnlessEqual(self.olut.verify("testapp", "1.1"), [])
+
+        self.olut.uninstall("testapp", "1.0")
+        self.olut.uninstall("testapp", "1.1")
+        self.failUnlessEqual(os.listdir(os.path.join(TEMP_PATH, Olut.LAYERS_DIRNAME)), [])
+
+    def testReproducible(self):
+        import shutil
+        import time
+        srcpath = os.path.join(TEMP_PATH, "src", "testapp")
+        shutil.copytree(os.path.join(TEST_PATH, "testapp"), srcpath)
+        contents = []
+        for compression in ("gzip", "gzip", "none"):
+            pkgpath = self.olut.build(srcpath, TEMP_PATH, compression=compression, reproducible=True)
+            with open(pkgpath, "rb") as fp:
+                contents.append(fp.read())
+            os.utime(os.path.join(srcpath, "code.py"), (time.time() + 10, time.time() + 10))
+            os.chmod(os.path.join(srcpath, "code.py"), 0664)
+        self.failUnlessEqual(contents[0], contents[1])
+        meta = self.olut.get_package_info(pkgpath)
+        self.failUnless(meta["content_hash"])
+        self.failUnlessEqual([row[4] for row in self.olut.get_package_manifest(pkgpath)], [0, 0])
+
+    def testReproducibleGit(self):
+        import time
+        srcpath = os.path.join(TEMP_PATH, "src", "app")
+        os.makedirs(os.path.join(srcpath, "olut"))
+        with open(os.path.join(srcpath, "olut", "metadata.yaml"), "w") as fp:
+            fp.write("name: app\n")
+        with open(os.path.join(srcpath, "code.py"), "w") as fp:
+            fp.write("code")
+        subprocess.check_call(
+            "cd %s && git init -q && git add -A"
+            " && git -c user.name=test -c user.email=test@example.com commit -qm init" % srcpath,
+            shell=True)
+        # An untagged checkout is versioned by date so it has to come
+        # from the epoch too
+        first = self.olut.build(srcpath, os.path.join(TEMP_PATH, "first"), reproducible=True)
+        time.sleep(1.1)
+        second = self.olut.build(srcpath, os.path.join(TEMP_PATH, "second"), reproducible=True)
+        self.failUnlessEqual(os.path.basename(first), os.path.basename(second))
+        self.failUnlessEqual(open(first, "rb").read(), open(second, "rb").read())
+
+    def testBuildCacheGit(self):
+        import time
+        srcpath = os.path.join(TEMP_PATH, "src", "app")
+        os.makedirs(os.path.join(srcpath, "olut"))
+        with open(os.path.join(srcpath, "olut", "metadata.yaml"), "w") as fp:
+            fp.write("name: app\n")
+        with open(os.path.join(srcpath, "code.py"), "w") as fp:
+            fp.write("code")
+        subprocess.check_call(
+            "cd %s && git init -q && git add -A"
+            " && git -c user.name=test -c user.email=test@example.com commit -qm init" % srcpath,
+            shell=True)
+        # The version of an untagged checkout is the build time so the
+        # cached package is returned under its original version
+        first = self.olut.build(srcpath, TEMP_PATH, cache=True)
+        time.sleep(1.1)
+        self.failUnlessEqual(self.olut.build(srcpath, TEMP_PATH, cache=True), first)
+        with open(os.path.join(srcpath, "code.py"), "w") as fp:
+            fp.write("changed")
+        self.failIfEqual(self.olut.build(srcpath, TEMP_PATH, cache=True), first)
+
+    def testRepository(self):
+        import SimpleHTTPServer
+        import SocketServer
+        import threading
+        repo_path = os.path.join(TEMP_PATH, "repo")
+        os.makedirs(repo_path)
+        self.olut.index_repository(repo_path)
+        for version, branch in (("1.0", "master"), ("1.1", "feature"), ("1.2", "master")):
+            self.olut.build(os.path.join(TEST_PATH, "testapp"), repo_path,
+                metaoverride={"version": version, "scm": {"branch": branch}})
+        index = self.olut.load_repository_index(repo_path)
+        self.failUnlessEqual(sorted(index["testapp"]), ["1.0", "1.1", "1.2"])
+        self.failUnlessEqual(index["testapp"]["1.1"]["branch"], "feature")
+
+        olut = Olut(os.path.join(TEMP_PATH, "install"), repository=repo_path)
+        self.failUnlessEqual(olut.install("testapp")["version"], "1.2")
+        self.failUnlessEqual(olut.install("testapp@feature")["version"], "1.1")
+        self.failUnlessEqual(olut.install("testapp@2")["version"], "1.0")
+        self.failUnlessRaises(Exception, olut.install, "other")
+
+        # Serve the same directory over http
+        handler = SimpleHTTPServer.SimpleHTTPRequestHandler
+        handler.log_message = lambda *args: None
+        cwd = os.getcwd()
+        os.chdir(repo_path)
+        server = SocketServer.TCPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            olut = Olut(os.path.join(TEMP_PATH, "http"), repository="http://127.0.0.1:%d/" % server.server_address[1])
+            self.failUnlessEqual(olut.install("testapp@master")["version"], "1.2")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            os.chdir(cwd)
+        self.failUnless(os.path.exists(os.path.join(TEMP_PATH, "http", "testapp", "1.2", "code.py")))
+
+    def testStagedInstall(self):
+        self.olut = Olut(TEMP_PATH, durable=True)
+        pkgpath = self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH)
+        self.olut.install(pkgpath)
+        self.failUnless(os.path.exists("%s/testapp/1.0/code.py" % TEMP_PATH))
+        self.failUnlessRaises(Exception, self.olut.install, pkgpath)
+
+        # A failure part way through leaves nothing behind
+        layers = [dict(name="olut", paths=["olut/"])]
+        pkgpath = self.olut.build(os.path.join(TEST_PATH, "testapp"), TEMP_PATH,
+            metaoverride={"version": "1.1", "layers": layers})
+        os.unlink(os.path.join(TEMP_PATH, self.olut.get_package_info(pkgpath)["layers"][0]["file"]))
+        self.failUnlessRaises(Exception, self.olut.install, pkgpath)
+        self.failIf(os.path.exists("%s/testapp/1.1" % TEMP_PATH))
+        self.failIf([x for x in os.listdir(TEMP_PATH) if x.startswith(".staging-")])
+
+        # Nor does one that doesn't fit
+        class statvfs_result(object):
+            f_frsize = 4096
+            f_bavail = 0
+        statvfs = os.statvfs
+        os.statvfs = lambda path: statvfs_result()
+        try:
+            self.failUnlessRaises(Exception, self.olut.install, pkgpath, metaoverride={"version": "1.2"})
+        finally:
+            os.statvfs = statvfs
+        self.failIf(os.path.exists("%s/testapp/1.2" % TEMP_PATH))
+
+    def testTruncatedPackage(self):
+        import shutil
+        srcpath = os.path.join(TEMP_PATH, "src", "testapp")
+        shutil.copytree(os.path.join(TEST_PATH, "testapp"), srcpath)
+        # Empty files are all headers so any cut ends on or in one
+        for i in range(2000):
+            open(os.path.join(srcpath, "file%04d" % i), "wb").close()
+        for compression in ("zstd", "xz"):
+            pkgpath = self.olut.build(srcpath, TEMP_PATH, compression=compression)
+            with open(pkgpath, "rb") as fp:
+                data = fp.read()
+            # Some of these cuts end the decompressed tar on a header
+            # boundary which tarfile alone can't tell from the real end
+            for percent in range(10, 100, 20):
+                with open(pkgpath, "wb") as fp:
+                    fp.write(data[:len(data) * percent // 100])
+                self.failUnlessRaises(Exception, self.olut.install, pkgpath)
+                self.failIf(os.path.exists("%s/testapp/1.0" % TEMP_PATH))
+                with open(pkgpath, "rb") as fp:
+                    self.failUnlessRaises(Exception, self.olut.install, fp)
+                self.failIf(os.path.exists("%s/testapp/1.0" % TEMP_PATH))
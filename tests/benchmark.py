@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""Benchmarks for building, installing and managing large synthetic packages.
+
+Run with: python -m tests.benchmark [options]
+
+Everything happens offline in a temporary directory. Results are written as
+JSON so runs can be compared with --compare.
+"""
+
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from olut.command import Olut
+from olut.version import VERSION
+
+# name -> (dirs, files per dir, file size, depth, symlinks, ignored files)
+PROFILES = {
+    "tiny": (100, 100, 64, 1, 0, 0),
+    "huge": (1, 4, 64*1024*1024, 1, 0, 0),
+    "deep": (20, 10, 1024, 20, 0, 0),
+    "symlinks": (50, 20, 1024, 1, 500, 0),
+    "ignored": (20, 50, 1024, 1, 0, 10000),
+}
+
+def write_file(path, size):
+    # Incompressible data is more representative than zeros, so take it
+    # from urandom but reuse one block to keep generation cheap
+    block = os.urandom(min(size, 1024*1024))
+    with open(path, "wb") as fp:
+        remaining = size
+        while remaining > 0:
+            fp.write(block[:remaining])
+            remaining -= len(block)
+
+def generate_tree(path, profile, scale=1.0):
+    """Generate a source tree for a profile and return its file count"""
+    dirs, files, size, depth, symlinks, ignored = PROFILES[profile]
+    dirs = max(1, int(dirs * scale))
+    count = 0
+    os.makedirs(os.path.join(path, "olut"))
+    with open(os.path.join(path, "olut", "metadata.yaml"), "w") as fp:
+        fp.write("name: bench-%s\nversion: 1\n" % profile)
+    for d in range(dirs):
+        dirpath = os.path.join(path, *["d%d" % d] + ["sub%d" % x for x in range(depth - 1)])
+        os.makedirs(dirpath)
+        for f in range(files):
+            write_file(os.path.join(dirpath, "f%d.dat" % f), size)
+            count += 1
+    for s in range(int(symlinks * scale)):
+        os.symlink("d%d" % (s % dirs), os.path.join(path, "link%d" % s))
+        count += 1
+    if ignored:
+        ignored_path = os.path.join(path, "build")
+        os.makedirs(ignored_path)
+        for f in range(int(ignored * scale)):
+            write_file(os.path.join(ignored_path, "i%d.o" % f), 128)
+        with open(os.path.join(path, ".gitignore"), "w") as fp:
+            fp.write("build/\n")
+        subprocess.check_call(
+            "cd %s && git init -q && git add -A"
+            " && git -c user.name=bench -c user.email=bench@localhost commit -qm bench" % path,
+            shell=True)
+    return count
+
+def timeit(results, name, func, *args, **kwargs):
+    start = time.time()
+    ret = func(*args, **kwargs)
+    results[name] = round(time.time() - start, 4)
+    return ret
+
+def run_profile(tmp_path, profile, scale=1.0, versions=20, compression="gzip"):
+    results = {}
+    source_path = os.path.join(tmp_path, "src-%s" % profile)
+    install_path = os.path.join(tmp_path, "install-%s" % profile)
+    results["files"] = timeit(results, "generate", generate_tree, source_path, profile, scale)
+    olut = Olut(install_path)
+
+    pkgpath = timeit(results, "build", olut.build, source_path, tmp_path,
+        compression=compression, gitfiles=PROFILES[profile][5] > 0)
+    results["package_bytes"] = os.path.getsize(pkgpath)
+    timeit(results, "get_package_info", olut.get_package_info, pkgpath)
+    timeit(results, "install", olut.install, pkgpath)
+    start = time.time()
+    for i in range(1, versions):
+        olut.install(pkgpath, metaoverride={"version": i + 1})
+    results["install_versions"] = round(time.time() - start, 4)
+    name = "bench-%s" % profile
+
+    # Cold reads have to parse every version's metadata, warm ones hit
+    # the index
+    os.unlink(os.path.join(install_path, Olut.INDEX_FILENAME))
+    timeit(results, "get_versions_cold", olut.get_versions, name)
+    timeit(results, "get_versions", olut.get_versions, name)
+    timeit(results, "get_installed_list", olut.get_installed_list)
+    timeit(results, "activate", olut.activate, name, "1")
+    timeit(results, "activate_switch", olut.activate, name, "2")
+    return results
+
+def compare(results, baseline):
+    for profile, timings in sorted(results["profiles"].items()):
+        base = baseline["profiles"].get(profile)
+        if not base:
+            continue
+        print profile
+        for name, value in sorted(timings.items()):
+            if name in base and base[name]:
+                print "    %-20s %10.4f %10.4f %6.2fx" % (name, base[name], value, value / float(base[name]))
+
+def build_parser():
+    parser = OptionParser(usage="Usage: %prog [options] [profile] ...")
+    parser.add_option("-c", "--compression", dest="compression", help="Compression for built packages", default="gzip")
+    parser.add_option("-C", "--compare", dest="compare", help="Compare against the results in this file")
+    parser.add_option("-k", "--keep", dest="keep", help="Keep the temporary directory", default=False, action="store_true")
+    parser.add_option("-n", "--versions", dest="versions", type="int", help="Number of versions to install", default=20)
+    parser.add_option("-o", "--output", dest="output", help="Write results as JSON to this file")
+    parser.add_option("-s", "--scale", dest="scale", type="float", help="Scale the number of files in each profile", default=1.0)
+    parser.add_option("-t", "--tmp", dest="tmp", help="Directory to create the temporary directory in")
+    return parser
+
+def main():
+    parser = build_parser()
+    options, args = parser.parse_args()
+    profiles = args or sorted(PROFILES)
+    for profile in profiles:
+        if profile not in PROFILES:
+            parser.error("unknown profile %s (must be one of %s)" % (profile, ", ".join(sorted(PROFILES))))
+    logging.basicConfig(level=logging.WARNING)
+
+    results = dict(
+        olut_version = VERSION,
+        python = platform.python_version(),
+        platform = platform.platform(),
+        date = time.time(),
+        options = dict(scale=options.scale, versions=options.versions, compression=options.compression),
+        profiles = {},
+    )
+    tmp_path = tempfile.mkdtemp(prefix="olut-bench-", dir=options.tmp)
+    try:
+        for profile in profiles:
+            sys.stderr.write("Running %s\n" % profile)
+            results["profiles"][profile] = run_profile(
+                tmp_path, profile, options.scale, options.versions, options.compression)
+    finally:
+        if not options.keep:
+            shutil.rmtree(tmp_path)
+
+    if options.output:
+        with open(options.output, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as fp:
+            compare(results, json.load(fp))
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+if __name__ == "__main__":
+    main()